@@ -39,20 +39,35 @@
 # operating on a very simple model of a limit order book (LOB) exchange
 #
 # major simplifications in this version:
-#       (a) only one financial instrument being traded
-#       (b) traders can only trade contracts of size 1 (will add variable quantities later)
-#       (c) each trader can have max of one order per single orderbook.
+#       (a) only one financial instrument being traded, unless the session has several (see market_session),
+#           and then each has its own book and its own traders, who trade only that instrument
+#       (b) customer orders are for contracts of size 1 unless the order schedule says otherwise
+#           (the exchange matches multi-unit orders, with partial fills)
+#       (c) each trader can have max of one order per single orderbook,
+#           unless its type allows it to have many quotes live at once (see Trader.quote_overwrites)
 #       (d) traders can replace/overwrite earlier orders, and/or can cancel
 #       (d) simply processes each order in sequence and republishes LOB to all traders
-#           => no issues with exchange processing latency/delays or simultaneously issued orders.
+#           => no issues with exchange processing latency/delays or simultaneously issued orders,
+#           unless the session has a latency model (see market_session)
 #
 # NB this code has been written to be readable/intelligible, not efficient!
 
 import sys
 import math
+import bisect
+import heapq
+import itertools
+import operator
 import random
 import os
+import shutil
+import struct
+import multiprocessing
 import time as chrono
+import asyncio
+import json
+import threading
+import types
 
 # a bunch of system constants (globals)
 bse_sys_minprice = 1                    # minimum price in the system, in cents/pennies
@@ -62,8 +77,11 @@ ticksize = 1  # minimum change in price, in cents/pennies
 
 
 # an Order/quote has a trader id, a type (buy/sell) price, quantity, timestamp, and unique i.d.
+# __slots__ means no per-instance __dict__: orders are created by the million, so this saves a lot of memory
 class Order:
 
+    __slots__ = ('tid', 'otype', 'price', 'qty', 'time', 'qid')
+
     def __init__(self, tid, otype, price, qty, time, qid):
         self.tid = tid  # trader i.d.
         self.otype = otype  # order type
@@ -77,22 +95,141 @@ class Order:
                (self.tid, self.otype, self.price, self.qty, self.time, self.qid)
 
 
+# records of events on the tape (and in traders' blotters), as __slots__ classes rather than dictionaries
+# they can still be read like dictionaries, e.g. trade['price'], so code written for dict records keeps working
+# the 'type' of a record ('Trade' or 'Cancel') is a class attribute, so it takes no space in each record
+
+class Tape_record:
+
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.fields]
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return str(dict(self.items()))
+
+
+class Trade_record(Tape_record):
+
+    __slots__ = ('time', 'price', 'party1', 'party2', 'qty', 'qid1', 'qid2')
+    fields = ('type', 'time', 'price', 'party1', 'party2', 'qty', 'qid1', 'qid2')
+    type = 'Trade'
+
+    def __init__(self, time, price, party1, party2, qty, qid1, qid2):
+        self.time = time
+        self.price = price
+        self.party1 = party1    # trader-id of the counterparty whose order was on the book
+        self.party2 = party2    # trader-id of the party whose order hit/lifted it
+        self.qty = qty
+        self.qid1 = qid1        # quote i.d. of the order that was on the book
+        self.qid2 = qid2        # quote i.d. of the order that hit/lifted it
+
+
+# a Sweep_record is the one execution report for an order that traded with more than one order on the book:
+# fills is the list of Trade_records (one per counterparty, each also on the tape), qty is the total quantity,
+# price is the volume-weighted average price of the fills (just their price if they were all at one price),
+# party2 and qid2 are the order's trader and quote i.d., and party1 and qid1 are the counterparty and its quote i.d.
+# for the first fill
+# a responder that wants one price for the whole execution should use price; one that needs the prices the order
+# actually traded at (e.g. the furthest into the book it went) should go through fills
+
+class Sweep_record(Tape_record):
+
+    __slots__ = ('time', 'price', 'party1', 'party2', 'qty', 'qid1', 'qid2', 'fills')
+    fields = ('type', 'time', 'price', 'party1', 'party2', 'qty', 'qid1', 'qid2', 'fills')
+    type = 'Trade'
+
+    def __init__(self, time, fills, party2, qid2):
+        self.time = time
+        self.party1 = fills[0].party1
+        self.party2 = party2
+        self.qid1 = fills[0].qid1
+        self.qid2 = qid2
+        qty = 0
+        value = 0
+        one_price = True
+        for fill in fills:
+            qty += fill.qty
+            value += fill.price * fill.qty
+            if fill.price != fills[0].price:
+                one_price = False
+        self.qty = qty
+        if one_price:
+            self.price = fills[0].price
+        else:
+            self.price = value / qty
+        self.fills = fills
+
+
+class Cancel_record(Tape_record):
+
+    __slots__ = ('time', 'order')
+    fields = ('type', 'time', 'order')
+    type = 'Cancel'
+
+    def __init__(self, time, order):
+        self.time = time
+        self.order = order
+
+
 # Orderbook_half is one side of the book: a list of bids or a list of asks, each sorted best-first
+# the price levels (lob) and the anonymized list (lob_anon) are maintained incrementally as orders come and go,
+# so each add/delete only touches the one price level that the order sits on
 
 class Orderbook_half:
 
     def __init__(self, booktype, worstprice):
         # booktype: bids or asks?
         self.booktype = booktype
-        # dictionary of orders received, indexed by Trader ID
+        # dictionary of orders received, indexed by quote i.d.
+        # so an order can be found (e.g. to cancel it) without a search
         self.orders = {}
+        # each trader's orders on this side of the book:
+        # dictionary indexed by Trader ID, of dictionaries indexed by quote i.d.
+        self.trader_orders = {}
+        # queue rank of each order in self.orders: an overwrite keeps the rank of the order it replaces
+        self.ranks = {}
+        self.next_rank = 0
         # limit order book, dictionary indexed by price, with order info
         self.lob = {}
         # anonymized LOB, lists, with only price/qty info
         self.lob_anon = []
+        # prices of the levels that have changed since a LOB_frame_writer last looked: None until a LOB_frame_writer
+        # first looks at this side of the book, so nothing is kept when no frames are being written
+        self.changed = None
         # summary stats
         self.best_price = None
         self.best_tid = None
+        self.best_qid = None
         self.worstprice = worstprice
         self.session_extreme = None    # most extreme price quoted in this session
         self.n_orders = 0  # how many orders?
@@ -112,9 +249,12 @@ class Orderbook_half:
         # NB the exchange needs to know arrival times and trader-id associated with each order
         # returns lob as a dictionary (i.e., unsorted)
         # also builds anonymized version (just price/quantity, sorted, as a list) for publishing to traders
+        # NB no longer called on every add/delete (the book is maintained incrementally) but kept for a full rebuild
+        if self.changed is not None:
+            self.changed.update(self.lob)
         self.lob = {}
-        for tid in self.orders:
-            order = self.orders.get(tid)
+        for qid in self.orders:
+            order = self.orders.get(qid)
             price = order.price
             if price in self.lob:
                 # update existing entry
@@ -125,255 +265,1183 @@ class Orderbook_half:
             else:
                 # create a new dictionary entry
                 self.lob[price] = [order.qty, [[order.time, order.qty, order.tid, order.qid]]]
+        if self.changed is not None:
+            self.changed.update(self.lob)
         # create anonymized version
         self.anonymize_lob()
-        # record best price and associated trader-id
-        if len(self.lob) > 0:
+        self.set_best()
+
+        if lob_verbose:
+            print(self.lob)
+
+    def lob_top(self, n):
+        # the best n price levels of lob_anon (all of them if n is None),
+        # still sorted lowest price first, so for bids the best is last and for asks the best is first
+        # always a new list, as lob_anon itself changes with the book (its [price, qty] items are replaced, not altered)
+        if n is None or n >= len(self.lob_anon):
+            return self.lob_anon[:]
+        if n <= 0:
+            return []
+        if self.booktype == 'Bid':
+            return self.lob_anon[-n:]
+        else:
+            return self.lob_anon[:n]
+
+    def set_best(self):
+        # record best price and associated trader-id and quote i.d.
+        self.lob_depth = len(self.lob_anon)
+        if self.lob_depth > 0:
             if self.booktype == 'Bid':
                 self.best_price = self.lob_anon[-1][0]
             else:
                 self.best_price = self.lob_anon[0][0]
-            self.best_tid = self.lob[self.best_price][1][0][2]
+            head = self.lob[self.best_price][1][0]
+            self.best_tid = head[2]
+            self.best_qid = head[3]
         else:
             self.best_price = None
             self.best_tid = None
+            self.best_qid = None
+
+    def queue_add(self, orderlist, entry, rank):
+        # orders at the same price queue in order of rank (same order as iterating over self.orders)
+        i = len(orderlist)
+        while i > 0 and self.ranks[orderlist[i - 1][3]] > rank:
+            i -= 1
+        orderlist.insert(i, entry)
+
+    def queue_del(self, orderlist, order):
+        # take one order out of the queue at its price level
+        for i in range(len(orderlist)):
+            if orderlist[i][3] == order.qid:
+                del (orderlist[i])
+                break
 
-        if lob_verbose:
-            print(self.lob)
+    def level_price(self, level):
+        # the price a level is published at: that of the order at the front of its queue, as it was when build_lob()
+        # made each level from the first order at that price (so 97 and 97.0 come out just as they always have)
+        return self.orders[level[1][0][3]].price
+
+    def level_add(self, order, rank):
+        # add one order to its price level, creating the level if need be
+        price = order.price
+        entry = [order.time, order.qty, order.tid, order.qid]
+        if self.changed is not None:
+            self.changed.add(price)
+        level = self.lob.get(price)
+        if level is None:
+            self.lob[price] = [order.qty, [entry]]
+            bisect.insort(self.lob_anon, [price, order.qty])
+        else:
+            level[0] += order.qty
+            self.queue_add(level[1], entry, rank)
+            self.lob_anon[bisect.bisect_left(self.lob_anon, [price])] = [self.level_price(level), level[0]]
+
+    def level_del(self, order):
+        # remove one order from its price level, deleting the level if it is now empty
+        price = order.price
+        level = self.lob[price]
+        if self.changed is not None:
+            self.changed.add(price)
+        self.queue_del(level[1], order)
+        level[0] -= order.qty
+        i = bisect.bisect_left(self.lob_anon, [price])
+        if len(level[1]) > 0:
+            self.lob_anon[i] = [self.level_price(level), level[0]]
+        else:
+            del (self.lob[price])
+            del (self.lob_anon[i])
+
+    def level_fill(self, order, qty):
+        # reduce the quantity of an order on its price level by qty (which is less than the order's qty)
+        price = order.price
+        level = self.lob[price]
+        if self.changed is not None:
+            self.changed.add(price)
+        for entry in level[1]:
+            if entry[3] == order.qid:
+                entry[1] -= qty
+                break
+        level[0] -= qty
+        self.lob_anon[bisect.bisect_left(self.lob_anon, [price])] = [self.level_price(level), level[0]]
 
-    def book_add(self, order):
+    def book_add(self, order, overwrite=True):
         # add order to the dictionary holding the list of orders
-        # either overwrites old order from this trader
-        # or dynamically creates new entry in the dictionary
-        # so, max of one order per trader per list
-        # checks whether length or order list has changed, to distinguish addition/overwrite
+        # if overwrite is True (as it is for every trader in BSE1.x) the order replaces any earlier orders
+        # from the same trader on this side of the book, so that trader has max of one order on this side;
+        # if it's False the order is added alongside them, so a trader can have many orders live at once
+        # returns 'Overwrite' if earlier orders were replaced, otherwise 'Addition'
         # print('book_add > %s %s' % (order, self.orders))
 
-        # if this is an ask, does the price set a new extreme-high record?
-        if (self.booktype == 'Ask') and ((self.session_extreme is None) or (order.price > self.session_extreme)):
-            self.session_extreme = int(order.price)
+        self.note_extreme(order)
 
         # add the order to the book
-        n_orders = self.n_orders
-        self.orders[order.tid] = order
+        rank = None
+        if overwrite:
+            # overwrite: take the old order off its price level, new order inherits its rank
+            rank = self.trader_del(order.tid)
+        if rank is not None:
+            response = 'Overwrite'
+        else:
+            rank = self.next_rank
+            self.next_rank += 1
+            response = 'Addition'
+        self.ranks[order.qid] = rank
+        self.orders[order.qid] = order
+        tid_orders = self.trader_orders.get(order.tid)
+        if tid_orders is None:
+            self.trader_orders[order.tid] = {order.qid: order}
+        else:
+            tid_orders[order.qid] = order
         self.n_orders = len(self.orders)
-        self.build_lob()
+        self.level_add(order, rank)
+        self.set_best()
         # print('book_add < %s %s' % (order, self.orders))
-        if n_orders != self.n_orders:
-            return 'Addition'
-        else:
+        return response
+
+    def note_extreme(self, order):
+        # if this is an ask, does the price set a new extreme-high record?
+        if (self.booktype == 'Ask') and ((self.session_extreme is None) or (order.price > self.session_extreme)):
+            self.session_extreme = int(order.price)
+
+    def book_take(self, order, overwrite=True):
+        # an order that trades on arrival never rests on the book, but it counts as a quote all the same:
+        # it can set the session extreme, and (if overwrite is True) it replaces any earlier orders from this trader
+        self.note_extreme(order)
+        if overwrite and self.trader_del(order.tid) is not None:
+            self.set_best()
             return 'Overwrite'
+        else:
+            return 'Addition'
+
+    def trader_del(self, tid):
+        # take all of this trader's orders off this side of the book (without updating the best price)
+        # returns the best queue rank that any of them had, or None if the trader had no orders here
+        rank = None
+        tid_orders = self.trader_orders.get(tid)
+        if tid_orders is not None:
+            for old_order in list(tid_orders.values()):
+                old_rank = self.ranks[old_order.qid]
+                if rank is None or old_rank < rank:
+                    rank = old_rank
+                self.order_del(old_order)
+        return rank
 
     def book_del(self, order):
         # delete order from the dictionary holding the orders
-        # assumes max of one order per trader per list
-        # checks that the Trader ID does actually exist in the dict before deletion
+        # checks that the quote i.d. does actually exist in the dict before deletion
         # print('book_del %s',self.orders)
-        if self.orders.get(order.tid) is not None:
-            del (self.orders[order.tid])
-            self.n_orders = len(self.orders)
-            self.build_lob()
+        self.book_cancel(order.qid)
         # print('book_del %s', self.orders)
 
+    def order_del(self, order):
+        # delete an order that is known to be on this side of the book (without updating the best price)
+        self.level_del(order)
+        del (self.orders[order.qid])
+        del (self.ranks[order.qid])
+        tid_orders = self.trader_orders[order.tid]
+        del (tid_orders[order.qid])
+        if len(tid_orders) == 0:
+            del (self.trader_orders[order.tid])
+        self.n_orders = len(self.orders)
+
+    def quote_del(self, order):
+        # delete an order that is known to be on this side of the book
+        self.order_del(order)
+        self.set_best()
+
+    def book_cancel(self, qid):
+        # delete the order with this quote i.d., if it is still on the book
+        # returns the deleted order, or None if there was no such order (e.g. it has already been filled)
+        order = self.orders.get(qid)
+        if order is not None:
+            self.quote_del(order)
+        return order
+
+    def fill_best(self, qty):
+        # fill up to qty units from the order at the front of the queue at the best price
+        # returns [that order, quantity filled]: the order is deleted from the book once it's completely filled,
+        # otherwise its qty is reduced to what's left of it
+        order = self.orders[self.best_qid]
+        if qty >= order.qty:
+            self.quote_del(order)
+            return [order, order.qty]
+        self.level_fill(order, qty)
+        order.qty -= qty
+        return [order, qty]
+
     def delete_best(self):
         # delete order: when the best bid/ask has been hit, delete it from the book
         # the TraderID of the deleted order is return-value, as counterparty to the trade
-        best_price_orders = self.lob[self.best_price]
-        best_price_qty = best_price_orders[0]
-        best_price_counterparty = best_price_orders[1][0][2]
-        if best_price_qty == 1:
-            # here the order deletes the best price
-            del (self.lob[self.best_price])
-            del (self.orders[best_price_counterparty])
-            self.n_orders = self.n_orders - 1
-            if self.n_orders > 0:
-                if self.booktype == 'Bid':
-                    self.best_price = max(self.lob.keys())
-                else:
-                    self.best_price = min(self.lob.keys())
-                self.lob_depth = len(self.lob.keys())
+        best_price_counterparty = self.best_tid
+        self.quote_del(self.orders[self.best_qid])
+        return best_price_counterparty
+
+
+# Orderbook_ladder is an alternative to Orderbook_half, with the same public fields and methods
+# price levels are held in a dense array indexed by tick (price // ticksize), each holding a FIFO queue of orders
+# an occupancy bitmap (a Python int, bit i set when tick i has orders) gives the best price in a couple of int ops,
+# so adding, cancelling, filling, and finding the best price never have to look at the rest of the book
+# lob_anon is only rebuilt (by walking the set bits) when it is read after the book has changed
+# an order priced between two ticks goes on the ladder at the nearest tick that's no better for it (a bid is rounded
+# down, an ask up), and that's its price from then on, of the same type it came in as (so 100.5 becomes 101.0, not 101);
+# as for Orderbook_half, each level is published at the price of the order at the front of its queue
+
+class Orderbook_ladder(Orderbook_half):
+
+    def __init__(self, booktype, worstprice):
+        self.ladder = [None] * (int(bse_sys_maxprice // ticksize) + 1)
+        self.occupied = 0           # bitmap of which ticks on the ladder have orders
+        self.anon_cache = []        # lob_anon as last built
+        self.anon_stale = False     # has the book changed since anon_cache was built?
+        Orderbook_half.__init__(self, booktype, worstprice)
+
+    @property
+    def lob_anon(self):
+        # anonymized LOB, sorted lowest price first, built from the bitmap when it's needed
+        if self.anon_stale:
+            anon = []
+            bits = self.occupied
+            while bits:
+                lowbit = bits & -bits
+                i = lowbit.bit_length() - 1
+                anon.append([self.level_price(self.ladder[i]), self.ladder[i][0]])
+                bits ^= lowbit
+            self.anon_cache = anon
+            self.anon_stale = False
+        return self.anon_cache
+
+    @lob_anon.setter
+    def lob_anon(self, anon):
+        self.anon_cache = anon
+        self.anon_stale = False
+
+    def lob_top(self, n):
+        # as for Orderbook_half, but if lob_anon is out of date just walk the n best set bits instead of rebuilding it
+        if n is None or not self.anon_stale:
+            return Orderbook_half.lob_top(self, n)
+        top = []
+        bits = self.occupied
+        while bits and len(top) < n:
+            if self.booktype == 'Bid':
+                i = bits.bit_length() - 1
+                bits ^= (1 << i)
             else:
-                self.best_price = self.worstprice
-                self.lob_depth = 0
+                lowbit = bits & -bits
+                i = lowbit.bit_length() - 1
+                bits ^= lowbit
+            top.append([self.level_price(self.ladder[i]), self.ladder[i][0]])
+        if self.booktype == 'Bid':
+            top.reverse()
+        return top
+
+    def book_add(self, order, overwrite=True):
+        self.snap(order)
+        return Orderbook_half.book_add(self, order, overwrite)
+
+    def snap(self, order):
+        # put an order that's priced between two ticks on the tick that's no better for it
+        if self.booktype == 'Bid':
+            i = int(order.price // ticksize)
         else:
-            # best_bid_qty>1 so the order decrements the quantity of the best bid
-            # update the lob with the decremented order data
-            self.lob[self.best_price] = [best_price_qty - 1, best_price_orders[1][1:]]
-
-            # update the bid list: counterparty's bid has been deleted
-            del (self.orders[best_price_counterparty])
-            self.n_orders = self.n_orders - 1
-        self.build_lob()
-        return best_price_counterparty
+            i = -int(-order.price // ticksize)
+        price = i * ticksize
+        if price != order.price:
+            if isinstance(order.price, float):
+                price = float(price)
+            order.price = price
+
+    def tick(self, price):
+        # index on the ladder for this price (which is on a tick); extend the ladder if a quote lands beyond its end
+        i = int(price // ticksize)
+        if i < 0:
+            sys.exit('FAIL: negative price %s in Orderbook_ladder' % price)
+        if i >= len(self.ladder):
+            self.ladder.extend([None] * (i + 1 - len(self.ladder)))
+        return i
+
+    def set_best(self):
+        # record best price and associated trader-id and quote i.d., straight from the bitmap
+        self.lob_depth = len(self.lob)
+        bits = self.occupied
+        if bits:
+            if self.booktype == 'Bid':
+                i = bits.bit_length() - 1
+            else:
+                i = (bits & -bits).bit_length() - 1
+            head = self.ladder[i][1][0]
+            self.best_price = self.orders[head[3]].price
+            self.best_tid = head[2]
+            self.best_qid = head[3]
+        else:
+            self.best_price = None
+            self.best_tid = None
+            self.best_qid = None
+
+    def level_add(self, order, rank):
+        i = self.tick(order.price)
+        entry = [order.time, order.qty, order.tid, order.qid]
+        if self.changed is not None:
+            self.changed.add(i * ticksize)
+        level = self.ladder[i]
+        if level is None:
+            level = [order.qty, [entry]]
+            self.ladder[i] = level
+            self.lob[order.price] = level
+            self.occupied |= (1 << i)
+        else:
+            level[0] += order.qty
+            self.queue_add(level[1], entry, rank)
+        self.anon_stale = True
+
+    def level_del(self, order):
+        i = self.tick(order.price)
+        level = self.ladder[i]
+        if self.changed is not None:
+            self.changed.add(i * ticksize)
+        self.queue_del(level[1], order)
+        level[0] -= order.qty
+        if len(level[1]) == 0:
+            self.ladder[i] = None
+            del (self.lob[i * ticksize])
+            self.occupied &= ~(1 << i)
+        self.anon_stale = True
+
+    def level_fill(self, order, qty):
+        i = self.tick(order.price)
+        level = self.ladder[i]
+        if self.changed is not None:
+            self.changed.add(i * ticksize)
+        for entry in level[1]:
+            if entry[3] == order.qid:
+                entry[1] -= qty
+                break
+        level[0] -= qty
+        self.anon_stale = True
 
 
 # Orderbook for a single instrument: list of bids and list of asks
 
+# Tape is the exchange's record of recent events (trades and cancellations), held in a fixed-size ring buffer:
+# records are written at the head, and once the buffer is full each new record overwrites the oldest one
+# so appending is O(1), rather than re-slicing a list to keep only the most recent items
+# indexing and iteration work like a list of records, oldest first (so tape[-1] is the latest event)
+# every record also gets a sequence number, counting up from 1 and never reset, and tape.seq is the latest of these:
+# tape.since(n) returns just the records after sequence number n, so a trader can pick up only what's new
+
+class Tape:
+
+    def __init__(self, capacity):
+        self.capacity = capacity                # max number of records held
+        self.records = [None] * capacity        # the ring buffer
+        self.head = 0                           # index in self.records where the next record is written
+        self.n_records = 0                      # number of records currently held
+        self.seq = 0                            # sequence number of the latest record (= number ever appended)
+        self.view = Tape_view(self)             # read-only view, for publishing to traders
+        self.archive = None                     # optional Tape_archive that every record is also written to
+
+    def append(self, record):
+        if self.archive is not None:
+            self.archive.write(record)
+        self.records[self.head] = record
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        if self.n_records < self.capacity:
+            self.n_records += 1
+        self.seq += 1
+
+    def since(self, seq):
+        # list of records with sequence number > seq, oldest first
+        # (if some of those have already dropped off the tape, then only the ones still held)
+        n_new = min(self.seq - seq, self.n_records)
+        if n_new <= 0:
+            return []
+        return [self.records[i % self.capacity] for i in range(self.head - n_new, self.head)]
+
+    def clear(self):
+        # NB the archive, if there is one, keeps everything: see Exchange.tape_dump()
+        self.records = [None] * self.capacity
+        self.head = 0
+        self.n_records = 0
+
+    def __len__(self):
+        return self.n_records
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n_records))]
+        if i < 0:
+            i += self.n_records
+        if i < 0 or i >= self.n_records:
+            raise IndexError('tape index out of range')
+        return self.records[(self.head - self.n_records + i) % self.capacity]
+
+    def __iter__(self):
+        start = self.head - self.n_records
+        for i in range(start, self.head):
+            yield self.records[i % self.capacity]
+
+
+# Tape_view gives read access to a Tape (len, indexing, slicing, iteration, seq, since) but has no way to alter it
+# if upto is given, the view shows the tape as it was when its latest event had that sequence number,
+# i.e. any events appended since then are hidden (for LOB data that reaches a trader after a delay)
+
+class Tape_view:
+
+    def __init__(self, tape, upto=None):
+        self._tape = tape
+        self._upto = upto
+
+    def n_hidden(self):
+        # how many of the tape's latest events this view doesn't show
+        if self._upto is None:
+            return 0
+        return self._tape.seq - self._upto
+
+    @property
+    def seq(self):
+        if self._upto is None:
+            return self._tape.seq
+        return self._upto
+
+    def since(self, seq):
+        records = self._tape.since(seq)
+        if self._upto is None:
+            return records
+        return records[:max(0, len(records) - self.n_hidden())]
+
+    def __len__(self):
+        return max(0, len(self._tape) - self.n_hidden())
+
+    def __getitem__(self, i):
+        if self._upto is None:
+            return self._tape[i]
+        n = len(self)
+        if isinstance(i, slice):
+            return [self._tape[j] for j in range(*i.indices(n))]
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError('tape index out of range')
+        return self._tape[i]
+
+    def __iter__(self):
+        if self._upto is None:
+            return iter(self._tape)
+        return iter(self[0:len(self)])
+
+
+# Tape_archive is an append-only file holding every event that has ever gone onto the tape
+# so that the in-memory Tape can stay small without older events being lost
+# records are formatted as CSV lines and written to disk in large chunks; records() streams them back in order
+
+class Tape_archive:
+
+    def __init__(self, fname, chunk_size=10000):
+        self.fname = fname
+        self.chunk_size = chunk_size    # how many records to buffer before writing them to disk
+        self.buffer = []                # formatted lines not yet written
+        self.n_records = 0              # total number of records archived
+        self.file = open(fname, 'w')
+
+    def write(self, record):
+        if record.type == 'Trade':
+            line = 'Trade,%r,%s,%s,%s,%s,%s,%s\n' % (record.time, record.price, record.party1, record.party2,
+                                                     record.qty, record.qid1, record.qid2)
+        else:
+            order = record.order
+            line = 'Cancel,%r,%s,%s,%s,%s,%s\n' % (record.time, order.tid, order.otype,
+                                                  order.price, order.qty, order.qid)
+        self.append(line)
+
+    def append(self, line):
+        self.buffer.append(line)
+        self.n_records += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+
+    def fork(self, fname):
+        # carry on in a copy of the file called fname, which starts with everything archived so far
+        # (this is for a forked process, which mustn't go on writing to the same file as its parent)
+        self.flush()
+        self.file.close()
+        shutil.copyfile(self.fname, fname)
+        self.fname = fname
+        self.file = open(fname, 'a')
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def records(self):
+        # generator: every archived record, oldest first, read back one line at a time
+
+        def number(s):
+            try:
+                return int(s)
+            except ValueError:
+                return float(s)
+
+        self.flush()
+        with open(self.fname, 'r') as archive:
+            for line in archive:
+                fields = line.rstrip('\n').split(',')
+                if fields[0] == 'Trade':
+                    yield Trade_record(float(fields[1]), number(fields[2]), fields[3], fields[4], number(fields[5]),
+                                       int(fields[6]), int(fields[7]))
+                else:
+                    order = Order(fields[2], fields[3], number(fields[4]), number(fields[5]),
+                                  float(fields[1]), number(fields[6]))
+                    yield Cancel_record(float(fields[1]), order)
+
+
+# Journal is an append-only file of everything the Exchange has accepted, in the order it accepted it:
+# each order (with the quote i.d. the exchange gave it), each cancellation, each call auction, and each trade
+# the orders, cancellations and auctions are all that's needed to rebuild the book: see replay_journal()
+# lines are CSV, starting with the event type:
+#   Order,time,tid,otype,price,qty,qid,overwrite,match  (match is 0 for an order that's just added to the book)
+#   Cancel,time,otype,qid
+#   Auction,time
+#   Trade,time,price,party1,party2,qty,qid1,qid2
+# each time is when the exchange accepted the event (for an order, not when the trader issued it),
+# so the times in a journal never go down
+
+class Journal(Tape_archive):
+
+    def __init__(self, fname, chunk_size=10000):
+        Tape_archive.__init__(self, fname, chunk_size)
+        self.last_time = None       # time of the latest event journalled
+
+    def stamp(self, time):
+        # an event is about to be journalled at this time: it mustn't be earlier than the last one
+        if self.last_time is not None and time < self.last_time:
+            sys.exit('FAIL: journal time went back from %r to %r' % (self.last_time, time))
+        self.last_time = time
+
+    def order(self, time, order, qid, overwrite, match):
+        self.stamp(time)
+        self.append('Order,%r,%s,%s,%s,%s,%d,%d,%d\n' % (time, order.tid, order.otype, order.price, order.qty,
+                                                        qid, overwrite, match))
+
+    def cancel(self, time, order):
+        self.stamp(time)
+        self.append('Cancel,%r,%s,%d\n' % (time, order.otype, order.qid))
+
+    def auction(self, time):
+        self.stamp(time)
+        self.append('Auction,%r\n' % time)
+
+    def trade(self, record):
+        self.stamp(record.time)
+        self.append('Trade,%r,%s,%s,%s,%s,%s,%s\n' % (record.time, record.price, record.party1, record.party2,
+                                                     record.qty, record.qid1, record.qid2))
+
+    def events(self):
+        # generator: every journalled event, oldest first, as a list of its fields (type and time first)
+        self.flush()
+        return journal_events(self.fname)
+
+
+def journal_events(fname):
+    # generator: the events in a journal file, oldest first, each as a list of its fields with numbers converted
+
+    def number(s):
+        try:
+            return int(s)
+        except ValueError:
+            return float(s)
+
+    with open(fname, 'r') as journal:
+        for line in journal:
+            fields = line.rstrip('\n').split(',')
+            etype = fields[0]
+            if etype == 'Order':
+                yield [etype, float(fields[1]), fields[2], fields[3], number(fields[4]), number(fields[5]),
+                       int(fields[6]), fields[7] == '1', fields[8] == '1']
+            elif etype == 'Cancel':
+                yield [etype, float(fields[1]), fields[2], int(fields[3])]
+            elif etype == 'Auction':
+                yield [etype, float(fields[1])]
+            else:
+                yield [etype, float(fields[1]), number(fields[2]), fields[3], fields[4], number(fields[5]),
+                       int(fields[6]), int(fields[7])]
+
+
+# replay_journal() rebuilds an Exchange from a journal alone, with no traders involved,
+# by re-applying every order, cancellation and auction in it with a time no later than until (None => all of them)
+# the trades aren't re-applied: they happen again, just as they did the first time, as the orders are re-applied
+# the exchange is returned, with its book (and tape) as they were at time until
+
+def replay_journal(fname, until=None, lob_type='dict'):
+    exchange = Exchange(lob_type)
+    for event in journal_events(fname):
+        etype = event[0]
+        time = event[1]
+        if until is not None and time > until:
+            break
+        if etype == 'Order':
+            order = Order(event[2], event[3], event[4], event[5], time, event[6])
+            if event[8]:
+                exchange.process_order2(time, order, False, event[7])
+            else:
+                exchange.add_order(time, order, False, event[7])
+            if order.qid != event[6]:
+                sys.exit('FAIL: replay_journal gave quote i.d. %d to journalled order %d' % (order.qid, event[6]))
+        elif etype == 'Cancel':
+            exchange.del_order(time, Order(None, event[2], None, None, time, event[3]), False)
+        elif etype == 'Auction':
+            exchange.clear_auction(time, False)
+    return exchange
+
+
+# Time_index writes a sparse sidecar index for a file of time-ordered records, in the file fname + '.idx':
+# time is divided into buckets of bucket seconds, and for each bucket that has any records in it the index gives
+# the byte offset in the file of the first of them, so a reader can seek straight to the records for a given time
+# (see time_index_offset() and load_window()) rather than scan the whole file
+# the index is CSV: a first line 'bucket,<bucket>', then a line '<time>,<offset>' for each bucket,
+# giving the time and offset of the first record in it
+
+class Time_index:
+
+    def __init__(self, fname, bucket, fmode='w'):
+        self.name = fname + '.idx'
+        self.bucket = bucket
+        self.last_bucket = None     # the bucket of the latest record noted
+        new_file = fmode == 'w' or not os.path.exists(self.name)
+        self.file = open(self.name, fmode)
+        if new_file:
+            self.file.write('bucket,%r\n' % bucket)
+
+    def due(self, time):
+        # is a record at this time the first one in a new bucket?
+        return int(time // self.bucket) != self.last_bucket
+
+    def add(self, time, offset):
+        # the record at this time, which is at this offset in the file, is the first one in its bucket
+        self.last_bucket = int(time // self.bucket)
+        self.file.write('%r,%d\n' % (time, offset))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def fork(self, fname):
+        # carry on in a copy of the index for fname (for a forked process, as for Tape_archive.fork)
+        self.file.close()
+        shutil.copyfile(self.name, fname + '.idx')
+        self.name = fname + '.idx'
+        self.file = open(self.name, 'a')
+
+
+def time_index_offset(fname, time):
+    # the byte offset in fname to start reading from to find records at this time, from the file's sidecar index:
+    # no record before the offset is at this time or later (0 if there's no index, or nothing to skip)
+    offset = 0
+    if not os.path.exists(fname + '.idx'):
+        return offset
+    with open(fname + '.idx', 'r') as index:
+        index.readline()
+        for line in index:
+            fields = line.split(',')
+            if float(fields[0]) > time:
+                break
+            offset = max(offset, int(fields[1]))
+    return offset
+
+
+def load_window(fname, start, end, time_col):
+    # the lines of a time-ordered CSV file with start <= time <= end, each as a list of its fields,
+    # where time is the number in column time_col (1 for a _tape.csv file, 0 for a _LOB_frames.csv file)
+    # only that slice of the file is read, starting from the offset given by its sidecar index (if it has one)
+    rows = []
+    with open(fname, 'rb') as f:
+        f.seek(time_index_offset(fname, start))
+        for line in f:
+            fields = [field.strip() for field in line.decode().rstrip('\n').split(',')]
+            time = float(fields[time_col])
+            if time > end:
+                break
+            if time >= start:
+                rows.append(fields)
+    return rows
+
+
+# LOB_frame_writer writes LOB frames (see Exchange.publish_lob) to a binary file, as an alternative to the CSV file:
+# rather than the whole book every time it changes, each frame is just the price levels that have changed since
+# the previous frame (a delta), so writing a frame costs in proportion to the change, not to the depth of the book;
+# every keyframe_interval frames there's a keyframe that has the whole book, so a reader can start from there
+# the file starts with LOB_frame_magic, then each frame is a header packed as LOB_frame_header:
+#   frame type (b'K' for a keyframe, b'D' for a delta), time, number of bid levels, number of ask levels
+# followed by that many bid levels and then that many ask levels, each packed as LOB_frame_level: price, qty
+# in a delta, a level with qty 0 is one that has gone from the book
+# if index_bucket is given, a Time_index is written too, and the first frame in each of its buckets is a keyframe,
+# so a reader can seek straight to it
+
+LOB_frame_magic = b'BSELOB1\n'
+LOB_frame_header = struct.Struct('<cdII')
+LOB_frame_level = struct.Struct('<dq')
+
+
+class LOB_frame_writer:
+
+    def __init__(self, fname, keyframe_interval=1000, index_bucket=None):
+        self.name = fname
+        self.keyframe_interval = keyframe_interval
+        self.n_frames = 0           # number of frames written
+        self.n_delta = 0            # number of frames written since the last keyframe
+        self.index = None
+        if index_bucket is not None:
+            self.index = Time_index(fname, index_bucket)
+        self.bids = {}              # the book as of the last frame written: qty at each price, bids and asks
+        self.asks = {}
+        self.file = open(fname, 'wb')
+        self.file.write(LOB_frame_magic)
+
+    def write_frame(self, time, book):
+        # write a frame for the book (an Orderbook) at this time, if it has changed since the last frame
+        # the price levels that might have changed are those in each side's changed set, which this empties
+        bid_levels = self.level_changes(book.bids, self.bids)
+        ask_levels = self.level_changes(book.asks, self.asks)
+        if self.n_frames > 0 and len(bid_levels) == 0 and len(ask_levels) == 0:
+            return
+        new_bucket = self.index is not None and self.index.due(time)
+        if self.n_frames == 0 or self.n_delta >= self.keyframe_interval or new_bucket:
+            # the levels written so far, now brought up to date, are the whole book
+            ftype = b'K'
+            bid_levels = list(self.bids.items())
+            ask_levels = list(self.asks.items())
+            self.n_delta = 0
+            if new_bucket:
+                self.index.add(time, self.file.tell())
+        else:
+            ftype = b'D'
+            self.n_delta += 1
+        frame = [LOB_frame_header.pack(ftype, time, len(bid_levels), len(ask_levels))]
+        for price, qty in bid_levels:
+            frame.append(LOB_frame_level.pack(price, qty))
+        for price, qty in ask_levels:
+            frame.append(LOB_frame_level.pack(price, qty))
+        self.file.write(b''.join(frame))
+        self.n_frames += 1
+
+    def level_changes(self, half, written):
+        # list of [price, qty] for each level of this side of the book that's different from the last frame
+        changes = []
+        if half.changed is None:
+            # the first look at this side of the book: from now on it keeps track of the levels that change,
+            # and for now all of its levels are different from the last frame
+            half.changed = set(half.lob)
+        for price in half.changed:
+            level = half.lob.get(price)
+            if level is None:
+                qty = 0
+            else:
+                qty = level[0]
+            if qty != written.get(price, 0):
+                changes.append([price, qty])
+                if qty == 0:
+                    del (written[price])
+                else:
+                    written[price] = qty
+        half.changed.clear()
+        return changes
+
+    def flush(self):
+        self.file.flush()
+        if self.index is not None:
+            self.index.flush()
+
+    def close(self):
+        self.file.close()
+        if self.index is not None:
+            self.index.close()
+
+    def fork(self, fname):
+        # carry on in a copy of the file called fname (for a forked process, as for Tape_archive.fork)
+        self.file.close()
+        shutil.copyfile(self.name, fname)
+        self.name = fname
+        self.file = open(fname, 'ab')
+        if self.index is not None:
+            self.index.fork(fname)
+
+
+# LOB_frame_reader reads back a file written by LOB_frame_writer
+
+class LOB_frame_reader:
+
+    def __init__(self, fname):
+        self.name = fname
+
+    def frames(self, start=None):
+        # generator: every frame in the file, oldest first, as [type, time, bid levels, ask levels]
+        # where the levels are lists of [price, qty] (and prices that are whole numbers come back as ints)
+        # if start is given and the file has a sidecar index, the frames begin at the keyframe that the index gives
+        # for that time, skipping earlier frames that aren't needed to rebuild the book at start
+        with open(self.name, 'rb') as f:
+            if f.read(len(LOB_frame_magic)) != LOB_frame_magic:
+                sys.exit('FAIL: %s is not a binary LOB frames file' % self.name)
+            if start is not None:
+                f.seek(max(len(LOB_frame_magic), time_index_offset(self.name, start)))
+            while True:
+                header = f.read(LOB_frame_header.size)
+                if len(header) < LOB_frame_header.size:
+                    return
+                (ftype, time, n_bids, n_asks) = LOB_frame_header.unpack(header)
+                body = f.read((n_bids + n_asks) * LOB_frame_level.size)
+                levels = []
+                for (price, qty) in LOB_frame_level.iter_unpack(body):
+                    if price == int(price):
+                        price = int(price)
+                    levels.append([price, qty])
+                yield [ftype.decode(), time, levels[:n_bids], levels[n_bids:]]
+
+    def book_at(self, time):
+        # the book as it was at this time (i.e. as of the last frame no later than time)
+        # returned as [bids, asks], each a list of [price, qty] sorted lowest price first, like lob_anon
+        book = [time, [], []]
+        for book in self.books(time, time):
+            pass
+        return book[1:]
+
+    def books(self, start, end):
+        # generator: the book as it was at start, then as it was after each frame up to end,
+        # each as [time, bids, asks] with bids and asks as for book_at()
+        # only the part of the file needed is read, if the file has a sidecar index
+        bids = {}
+        asks = {}
+        at_start = True
+        ftime = start
+        for (ftype, ftime, bid_levels, ask_levels) in self.frames(start):
+            if ftime > end:
+                break
+            if ftime > start and at_start:
+                yield [start, self.levels(bids), self.levels(asks)]
+                at_start = False
+            if ftype == 'K':
+                bids = {}
+                asks = {}
+            for side, levels in [[bids, bid_levels], [asks, ask_levels]]:
+                for price, qty in levels:
+                    if qty == 0:
+                        del (side[price])
+                    else:
+                        side[price] = qty
+            if not at_start:
+                yield [ftime, self.levels(bids), self.levels(asks)]
+        if at_start:
+            yield [start, self.levels(bids), self.levels(asks)]
+
+    def levels(self, side):
+        # a dictionary of qty at each price as a list of [price, qty], sorted lowest price first
+        return sorted([[price, side[price]] for price in side])
+
+
+# lob_type chooses how each side of the book is held:
+# 'dict' is a dictionary of price levels (Orderbook_half); 'ladder' is a dense tick-ladder (Orderbook_ladder)
+
 class Orderbook(Orderbook_half):
 
-    def __init__(self):
-        self.bids = Orderbook_half('Bid', bse_sys_minprice)
-        self.asks = Orderbook_half('Ask', bse_sys_maxprice)
-        self.tape = []
+    def __init__(self, lob_type='dict', symbol=None):
+        if lob_type == 'dict':
+            self.bids = Orderbook_half('Bid', bse_sys_minprice)
+            self.asks = Orderbook_half('Ask', bse_sys_maxprice)
+        elif lob_type == 'ladder':
+            self.bids = Orderbook_ladder('Bid', bse_sys_minprice)
+            self.asks = Orderbook_ladder('Ask', bse_sys_maxprice)
+        else:
+            sys.exit('FAIL: unknown lob_type %s in Orderbook' % lob_type)
+        self.lob_type = lob_type
+        self.symbol = symbol        # the instrument traded on this book (None if there's only one)
         self.tape_length = 10000    # max number of events on tape (so we can do millions of orders without crashing)
+        self.tape = Tape(self.tape_length)
+        self.tape_wiped = 0         # how many archived tape events were wiped by tape_dump(), so aren't dumped again
         self.quote_id = 0           # unique ID code for each quote accepted onto the book
         self.lob_string = ''        # character-string linearization of public lob items with nonzero quantities
+        self.lob_version = 0        # goes up by one every time the book or the tape changes
+        self.lob_snapshots = {}     # last data published by publish_lob() at each depth, reused while lob_version is unchanged
+        self.lob_string_version = None  # lob_version when self.lob_string was last built
+        self.journal = None         # Journal of everything accepted by the exchange, if one is being kept
+        self.lob_index = None       # Time_index of the CSV LOB frames file written by publish_lob(), if one is kept
+
+
+# price levels as published to traders: a tuple of (price, qty) tuples, so they can be shared but not altered
+
+def frozen_levels(levels):
+    return tuple([tuple(level) for level in levels])
 
 
 # Exchange's internal orderbook
 
 class Exchange(Orderbook):
 
-    def add_order(self, order, verbose):
-        # add a quote/order to the exchange and update all internal records; return unique i.d.
+    def add_order(self, time, order, verbose, overwrite=True):
+        # add a quote/order to the exchange at this time and update all internal records; return unique i.d.
+        # overwrite: does the order replace the trader's earlier order(s) on the same side of the book?
+        if self.journal is not None:
+            self.journal.order(time, order, self.quote_id, overwrite, False)
+        return self.book_order(order, verbose, overwrite)
+
+    def book_order(self, order, verbose, overwrite):
+        # add_order() without the journal entry
         order.qid = self.quote_id
         self.quote_id = order.qid + 1
+        self.lob_version += 1
         # if verbose : print('QUID: order.quid=%d self.quote.id=%d' % (order.qid, self.quote_id))
         if order.otype == 'Bid':
-            response = self.bids.book_add(order)
-            best_price = self.bids.lob_anon[-1][0]
-            self.bids.best_price = best_price
-            self.bids.best_tid = self.bids.lob[best_price][1][0][2]
+            response = self.bids.book_add(order, overwrite)
         else:
-            response = self.asks.book_add(order)
-            best_price = self.asks.lob_anon[0][0]
-            self.asks.best_price = best_price
-            self.asks.best_tid = self.asks.lob[best_price][1][0][2]
+            response = self.asks.book_add(order, overwrite)
         return [order.qid, response]
 
+    def quote_live(self, qid):
+        # is the order with this quote i.d. still on the book?
+        return qid in self.bids.orders or qid in self.asks.orders
+
     def del_order(self, time, order, verbose):
-        # delete a trader's quot/order from the exchange, update all internal records
+        # delete a trader's quote/order from the exchange, update all internal records
+        # the quote is found by its quote i.d., so only its own price level is touched;
+        # cancelling a quote that is no longer on the book (e.g. because it has already traded) does nothing
         if order.otype == 'Bid':
-            self.bids.book_del(order)
-            if self.bids.n_orders > 0:
-                best_price = self.bids.lob_anon[-1][0]
-                self.bids.best_price = best_price
-                self.bids.best_tid = self.bids.lob[best_price][1][0][2]
-            else:  # this side of book is empty
-                self.bids.best_price = None
-                self.bids.best_tid = None
-            cancel_record = {'type': 'Cancel', 'time': time, 'order': order}
-            self.tape.append(cancel_record)
-            # NB this just throws away the older items on the tape -- could instead dump to disk
-            # right-truncate the tape so it keeps only the most recent items
-            self.tape = self.tape[-self.tape_length:]
-
+            cancelled = self.bids.book_cancel(order.qid)
         elif order.otype == 'Ask':
-            self.asks.book_del(order)
-            if self.asks.n_orders > 0:
-                best_price = self.asks.lob_anon[0][0]
-                self.asks.best_price = best_price
-                self.asks.best_tid = self.asks.lob[best_price][1][0][2]
-            else:  # this side of book is empty
-                self.asks.best_price = None
-                self.asks.best_tid = None
-            cancel_record = {'type': 'Cancel', 'time': time, 'order': order}
-            self.tape.append(cancel_record)
-            # NB this just throws away the older items on the tape -- could instead dump to disk
-            # right-truncate the tape so it keeps only the most recent items
-            self.tape = self.tape[-self.tape_length:]
+            cancelled = self.asks.book_cancel(order.qid)
         else:
             # neither bid nor ask?
             sys.exit('bad order type in del_quote()')
-
-    def process_order2(self, time, order, verbose):
+        if cancelled is None:
+            if verbose:
+                print('del_order: QID %d not on LOB' % order.qid)
+            return
+        self.lob_version += 1
+        if self.journal is not None:
+            self.journal.cancel(time, order)
+        cancel_record = Cancel_record(time, order)
+        # NB once the tape is full the oldest items on it are thrown away -- could instead dump to disk
+        self.tape.append(cancel_record)
+
+    def process_order2(self, time, order, verbose, overwrite=True):
         # receive an order and either add it to the relevant LOB (ie treat as limit order)
         # or if it crosses the best counterparty offer, execute it (treat as a market order)
+        # the opposite side of the book is checked first: an order that crosses trades straight away
+        # and never goes onto the book, so only orders that don't cross get added to the LOB
+        # an order for more than one unit sweeps through the opposite side in price-time priority,
+        # partially filling resting orders if need be, for as long as it still crosses;
+        # any quantity left over then goes onto the book as a limit order
+        # returns None if there was no trade; otherwise a single Trade_record if there was one fill,
+        # or a Sweep_record summarising all the fills (each of which is a Trade_record on the tape)
+        # overwrite is as for add_order: False lets the trader keep its earlier orders live alongside this one
         oprice = order.price
-        counterparty = None
-        price = None
-        [qid, response] = self.add_order(order, verbose)  # add it to the order lists -- overwriting any previous order
-        order.qid = qid
-        if verbose:
-            print('QUID: order.quid=%d' % order.qid)
-            print('RESPONSE: %s' % response)
-        best_ask = self.asks.best_price
-        best_ask_tid = self.asks.best_tid
-        best_bid = self.bids.best_price
-        best_bid_tid = self.bids.best_tid
         if order.otype == 'Bid':
-            if self.asks.n_orders > 0 and best_bid >= best_ask:
-                # bid lifts the best ask
-                if verbose:
-                    print("Bid $%s lifts best ask" % oprice)
-                counterparty = best_ask_tid
-                price = best_ask  # bid crossed ask, so use ask price
-                if verbose:
-                    print('counterparty, price', counterparty, price)
-                # delete the ask just crossed
-                self.asks.delete_best()
-                # delete the bid that was the latest order
-                self.bids.delete_best()
+            own, opposite = self.bids, self.asks
         elif order.otype == 'Ask':
-            if self.bids.n_orders > 0 and best_ask <= best_bid:
-                # ask hits the best bid
-                if verbose:
-                    print("Ask $%s hits best bid" % oprice)
-                # remove the best bid
-                counterparty = best_bid_tid
-                price = best_bid  # ask crossed bid, so use bid price
-                if verbose:
-                    print('counterparty, price', counterparty, price)
-                # delete the bid just crossed, from the exchange's records
-                self.bids.delete_best()
-                # delete the ask that was the latest order, from the exchange's records
-                self.asks.delete_best()
+            own, opposite = self.asks, self.bids
         else:
             # we should never get here
             sys.exit('process_order() given neither Bid nor Ask')
-        # NB at this point we have deleted the order from the exchange's records
-        # but the two traders concerned still have to be notified
+        if self.journal is not None:
+            self.journal.order(time, order, self.quote_id, overwrite, True)
+        crossed = opposite.n_orders > 0 and self.crosses(order, opposite.best_price)
+        if not crossed:
+            [qid, response] = self.book_order(order, verbose, overwrite)  # add it to the order lists
+            order.qid = qid
+        else:
+            # the order still gets a quote i.d., and still replaces any previous order from this trader (if overwrite)
+            order.qid = self.quote_id
+            self.quote_id = order.qid + 1
+            self.lob_version += 1
+            response = own.book_take(order, overwrite)
         if verbose:
-            print('counterparty %s' % counterparty)
-        if counterparty is not None:
-            # process the trade
+            print('QUID: order.quid=%d' % order.qid)
+            print('RESPONSE: %s' % response)
+        if not crossed:
+            return None
+
+        fills = []
+        remaining = order.qty
+        while remaining > 0 and opposite.n_orders > 0 and self.crosses(order, opposite.best_price):
+            # bid lifts the best ask, or ask hits the best bid: trade at the price of the order on the book
+            price = opposite.best_price
+            if verbose:
+                print("%s $%s crosses best %s $%s" % (order.otype, oprice, opposite.booktype, price))
+            [counterparty_order, qty] = opposite.fill_best(remaining)
+            remaining -= qty
+            counterparty = counterparty_order.tid
             if verbose:
+                print('counterparty, price, qty', counterparty, price, qty)
                 print('>>>>>>>>>>>>>>>>>TRADE t=%010.3f $%d %s %s' % (time, price, counterparty, order.tid))
-            transaction_record = {'type': 'Trade',
-                                  'time': time,
-                                  'price': price,
-                                  'party1': counterparty,
-                                  'party2': order.tid,
-                                  'qty': order.qty
-                                  }
+            transaction_record = Trade_record(time, price, counterparty, order.tid, qty,
+                                              counterparty_order.qid, order.qid)
+            # NB once the tape is full the oldest items on it are thrown away -- could instead dump to disk
             self.tape.append(transaction_record)
-            # NB this just throws away the older items on the tape -- could instead dump to disk
-            # right-truncate the tape so it keeps only the most recent items
-            self.tape = self.tape[-self.tape_length:]
+            if self.journal is not None:
+                self.journal.trade(transaction_record)
+            fills.append(transaction_record)
+
+        if remaining > 0:
+            # the rest of the order didn't cross, so it goes on the book (NB orders on the book hold their live qty)
+            order.qty = remaining
+            own.book_add(order, overwrite)
+
+        if len(fills) == 1:
+            return fills[0]
+        return Sweep_record(time, fills, order.tid, order.qid)
 
-            return transaction_record
+    def crosses(self, order, price):
+        # would this order trade against an order at the given price on the opposite side of the book?
+        if order.otype == 'Bid':
+            return order.price >= price
         else:
-            return None
+            return order.price <= price
+
+    # batch-auction mode: orders are put on the book with add_order() (so the book can be crossed) and every so often
+    # the whole book is cleared in one call auction, where all trades are at the same (uniform) price
+    # auction_price() finds that price from the cumulative demand and supply curves over the ticks where the book is
+    # crossed: demand at a price is the total qty bid at that price or higher, supply is the total qty offered at that
+    # price or lower, and the clearing price is the one where the most units trade (min of demand and supply);
+    # if there's a tie, it's the one with the smallest imbalance between demand and supply,
+    # and if there's still a tie it's the middle one of those
+    # returns [price, volume], or [None, 0] if the book isn't crossed
+
+    def auction_price(self):
+        if self.bids.n_orders == 0 or self.asks.n_orders == 0 or self.bids.best_price < self.asks.best_price:
+            return [None, 0]
+        lo = int(self.asks.best_price // ticksize)
+        hi = int(self.bids.best_price // ticksize)
+        n_ticks = hi - lo + 1
+        bid_qty = [0] * n_ticks
+        ask_qty = [0] * n_ticks
+        for price in self.bids.lob:
+            i = int(price // ticksize) - lo
+            if i >= 0:
+                bid_qty[i] += self.bids.lob[price][0]
+        for price in self.asks.lob:
+            i = int(price // ticksize) - lo
+            if i < n_ticks:
+                ask_qty[i] += self.asks.lob[price][0]
+        demand = list(itertools.accumulate(reversed(bid_qty)))
+        demand.reverse()
+        supply = list(itertools.accumulate(ask_qty))
+        volume = list(map(min, demand, supply))
+        imbalance = list(map(abs, map(operator.sub, demand, supply)))
+        max_volume = max(volume)
+        ticks = [i for i in range(n_ticks) if volume[i] == max_volume]
+        min_imbalance = min([imbalance[i] for i in ticks])
+        ticks = [i for i in ticks if imbalance[i] == min_imbalance]
+        return [(lo + ticks[len(ticks) // 2]) * ticksize, max_volume]
+
+    def clear_auction(self, time, verbose):
+        # run a call auction: the bids and asks that cross are filled in price-time priority, all at the auction price
+        # returns the list of Trade_records, one for each pairing of a bid with an ask (each is also on the tape):
+        # party1 is the trader whose bid it was, and party2 is the trader whose ask it was
+        [price, volume] = self.auction_price()
+        trades = []
+        if volume == 0:
+            return trades
+        self.lob_version += 1
+        if self.journal is not None:
+            self.journal.auction(time)
+        while volume > 0:
+            qty = min(volume, self.bids.orders[self.bids.best_qid].qty, self.asks.orders[self.asks.best_qid].qty)
+            [bid, qty] = self.bids.fill_best(qty)
+            [ask, qty] = self.asks.fill_best(qty)
+            volume -= qty
+            if verbose:
+                print('>>>>>>>>>>>>>>>>>AUCTION TRADE t=%010.3f $%d %s %s' % (time, price, bid.tid, ask.tid))
+            transaction_record = Trade_record(time, price, bid.tid, ask.tid, qty, bid.qid, ask.qid)
+            self.tape.append(transaction_record)
+            if self.journal is not None:
+                self.journal.trade(transaction_record)
+            trades.append(transaction_record)
+        return trades
+
+    # stream every tape event to an archive file from now on, rather than losing events that drop off the tape
+    def archive_tape(self, fname):
+        self.tape.archive = Tape_archive(fname)
+
+    # write everything the exchange accepts to a journal file from now on, so the session can be replayed
+    # NB a journal has to be started on an empty exchange for replay_journal() to rebuild it
+    def start_journal(self, fname):
+        self.journal = Journal(fname)
 
     # Currently tape_dump only writes a list of transactions (ignores cancellations)
-    def tape_dump(self, fname, fmode, tmode):
+    # if the tape is being archived then this is the complete list, otherwise it's just what's still on the tape
+    # (either way, less anything already dumped with tmode 'wipe', which empties the tape but leaves the archive alone)
+    # if index_bucket is given, a Time_index of the file is written too, with buckets of that many seconds
+    def tape_dump(self, fname, fmode, tmode, index_bucket=None):
         dumpfile = open(fname, fmode)
+        index = None
+        if index_bucket is not None:
+            index = Time_index(fname, index_bucket, fmode)
         # dumpfile.write('type, time, price\n')
-        for tapeitem in self.tape:
+        if self.tape.archive is not None:
+            tapeitems = itertools.islice(self.tape.archive.records(), self.tape_wiped, None)
+        else:
+            tapeitems = self.tape
+        for tapeitem in tapeitems:
             if tapeitem['type'] == 'Trade':
+                if index is not None and index.due(tapeitem['time']):
+                    index.add(tapeitem['time'], dumpfile.tell())
                 dumpfile.write('Trd, %010.3f, %s\n' % (tapeitem['time'], tapeitem['price']))
         dumpfile.close()
+        if index is not None:
+            index.close()
         if tmode == 'wipe':
-            self.tape = []
+            self.tape.clear()
+            if self.tape.archive is not None:
+                self.tape_wiped = self.tape.archive.n_records
+            self.lob_version += 1
 
     # this returns the LOB data "published" by the exchange,
     # i.e., what is accessible to the traders
-    def publish_lob(self, time, lob_file, verbose):
-        public_data = {}
-        public_data['time'] = time
-        public_data['bids'] = {'best': self.bids.best_price,
-                               'worst': self.bids.worstprice,
-                               'n': self.bids.n_orders,
-                               'lob': self.bids.lob_anon}
-        public_data['asks'] = {'best': self.asks.best_price,
-                               'worst': self.asks.worstprice,
-                               'sess_hi': self.asks.session_extreme,
-                               'n': self.asks.n_orders,
-                               'lob': self.asks.lob_anon}
-        public_data['QID'] = self.quote_id
-        public_data['tape'] = self.tape
-
-        if lob_file is not None:
+    # lob['version'] is the exchange's lob_version when the data was built:
+    # a trader can compare it with the version it last saw to tell whether anything has changed
+    # depth limits how many price levels are given in each side's 'lob' list: None for all of them, 1 for best only,
+    # N for the best N levels, 0 for none; only that many levels are built
+    # lob['tape_seq'] is the sequence number of the latest event on the tape:
+    # a trader that remembers it can later call lob['tape'].since(that_seq) to get only the events since then
+    def publish_lob(self, time, lob_file, verbose, depth=None):
+        # the published data only changes when lob_version does, so the last snapshot is reused until then:
+        # each caller gets its own copy of the top-level dict, with its own time, sharing the rest, which is frozen
+        # (read-only bids/asks mappings, and levels as tuples of (price, qty) tuples) so no caller can alter it for others
+        public_data = self.lob_snapshots.get(depth)
+        if public_data is not None and public_data['version'] == self.lob_version:
+            public_data = dict(public_data)
+            public_data['time'] = time
+        else:
+            public_data = {}
+            public_data['time'] = time
+            public_data['symbol'] = self.symbol
+            public_data['version'] = self.lob_version
+            public_data['bids'] = types.MappingProxyType({'best': self.bids.best_price,
+                                                          'worst': self.bids.worstprice,
+                                                          'n': self.bids.n_orders,
+                                                          'lob': frozen_levels(self.bids.lob_top(depth))})
+            public_data['asks'] = types.MappingProxyType({'best': self.asks.best_price,
+                                                          'worst': self.asks.worstprice,
+                                                          'sess_hi': self.asks.session_extreme,
+                                                          'n': self.asks.n_orders,
+                                                          'lob': frozen_levels(self.asks.lob_top(depth))})
+            public_data['QID'] = self.quote_id
+            public_data['tape'] = self.tape.view
+            public_data['tape_seq'] = self.tape.seq
+            self.lob_snapshots[depth] = public_data
+
+        if isinstance(lob_file, LOB_frame_writer):
+            # binary frames: only the levels that have changed get written
+            if self.lob_string_version != self.lob_version:
+                lob_file.write_frame(time, self)
+                self.lob_string_version = self.lob_version
+        elif lob_file is not None and self.lob_string_version != self.lob_version:
             # build a linear character-string summary of only those prices on LOB with nonzero quantities
             lobstring = 'Bid:,'
             n_bids = len(self.bids.lob_anon)
@@ -395,23 +1463,364 @@ class Exchange(Orderbook):
                     lobstring = lobstring + price_str + qty_str
             else:
                 lobstring += '0,'
+            self.lob_string_version = self.lob_version
             # is this different to the last lob_string?
             if lobstring != self.lob_string:
                 # write it
+                if self.lob_index is not None and self.lob_index.due(time):
+                    self.lob_index.add(time, lob_file.tell())
                 lob_file.write('%.3f, %s\n' % (time, lobstring))
                 # remember it
                 self.lob_string = lobstring
 
         if verbose:
             print('publish_lob: t=%d' % time)
-            print('BID_lob=%s' % public_data['bids']['lob'])
+            print('BID_lob=%s' % [list(level) for level in public_data['bids']['lob']])
             # print('best=%s; worst=%s; n=%s ' % (self.bids.best_price, self.bids.worstprice, self.bids.n_orders))
-            print('ASK_lob=%s' % public_data['asks']['lob'])
+            print('ASK_lob=%s' % [list(level) for level in public_data['asks']['lob']])
             # print('qid=%d' % self.quote_id)
 
         return public_data
 
 
+# Exchange_multi hosts many instruments, each with its own Exchange (i.e. its own Orderbook, tape, and quote i.d.s),
+# indexed by symbol; exchange[symbol] is the Exchange for that instrument
+# its methods are those of Exchange, with the symbol of the instrument as an extra argument (after the time, if any)
+
+class Exchange_multi:
+
+    def __init__(self, symbols, lob_type='dict'):
+        self.symbols = list(symbols)
+        self.exchanges = {}
+        for symbol in self.symbols:
+            self.exchanges[symbol] = Exchange(lob_type, symbol)
+
+    def __getitem__(self, symbol):
+        return self.exchanges[symbol]
+
+    def add_order(self, time, symbol, order, verbose, overwrite=True):
+        return self.exchanges[symbol].add_order(time, order, verbose, overwrite)
+
+    def process_order2(self, time, symbol, order, verbose, overwrite=True):
+        return self.exchanges[symbol].process_order2(time, order, verbose, overwrite)
+
+    def clear_auction(self, time, symbol, verbose):
+        return self.exchanges[symbol].clear_auction(time, verbose)
+
+    def del_order(self, time, symbol, order, verbose):
+        self.exchanges[symbol].del_order(time, order, verbose)
+
+    def quote_live(self, symbol, qid):
+        return self.exchanges[symbol].quote_live(qid)
+
+    def archive_tape(self, symbol, fname):
+        self.exchanges[symbol].archive_tape(fname)
+
+    def start_journal(self, symbol, fname):
+        self.exchanges[symbol].start_journal(fname)
+
+    # the LOB data published for just the one instrument
+    def publish_lob(self, time, symbol, lob_file, verbose, depth=None):
+        return self.exchanges[symbol].publish_lob(time, lob_file, verbose, depth)
+
+
+# Event_queue is a priority queue of timestamped events, held in a heap, so push() and pop() are O(log n)
+# however many events are waiting; events with the same time come out in the order they were pushed
+
+class Event_queue:
+
+    def __init__(self):
+        self.heap = []
+        self.n_pushed = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, time, event):
+        heapq.heappush(self.heap, (time, self.n_pushed, event))
+        self.n_pushed += 1
+
+    def next_time(self):
+        # time of the earliest event
+        return self.heap[0][0]
+
+    def pop(self):
+        # remove the earliest event, returning [its time, the event]
+        entry = heapq.heappop(self.heap)
+        return [entry[0], entry[2]]
+
+    def pop_before(self, time):
+        # remove every event earlier than time, returning a list of them in the order they were pushed
+        # (only the events that are due are touched, however many are still waiting)
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] < time:
+            due.append(heapq.heappop(self.heap))
+        if len(due) > 1:
+            due.sort(key=operator.itemgetter(1))
+        return [entry[2] for entry in due]
+
+# Exchange_gateway lets traders that run as separate processes take part in a market_session, over a local TCP socket
+# (address is (host, port); port 0 picks a free one) or a Unix socket (address is its path)
+# start() runs an asyncio server in a thread of its own, then the gateway is given to market_session as
+# sess_params['gateway']; each external trader stands in the session's population as a Trader_Remote (robot type
+# 'REMOTE' in trader_spec) and works customer orders just as the robots do; a connection that doesn't say which
+# trader it is just watches the market
+# the protocol is newline-delimited JSON: each line a client sends is one message, or a list of them (a batch):
+#   {"op": "hello", "tid": "B03", "symbol": null}                  this connection is trader B03 (of that instrument)
+#   {"op": "order", "otype": "Bid", "price": 120, "qty": 1, "ref": 7}  a quote (ref comes back in its ack or reject)
+#   {"op": "cancel", "qid": 1234}                                    cancel one of its live quotes
+# each line the gateway sends is a list of every event queued for that connection since its last line:
+#   to every connection (for its instrument): 'lob' (the best lob_depth levels of each side), 'trade', 'end'
+#   to a trader's own connection: 'welcome', 'assign' (a new customer order), 'ack', 'reject', 'fill',
+#   'gone' (a quote is no longer live), 'done' (the customer order has been dealt with)
+# back-pressure: a connection that has max_pending messages waiting for the session isn't read from until the session
+# has taken them, so a client that sends too fast is held back by its own socket; 'lob' events are conflated, so a
+# slow reader just gets the latest book, and a connection that falls max_backlog other events behind is dropped
+# the session only touches the gateway through take(), send(), publish(), flush(), keep_pace() and end_session();
+# everything else runs in the gateway's thread
+
+class Exchange_gateway:
+
+    def __init__(self, address, lob_depth=5, pace=None, max_pending=1000, max_backlog=10000):
+        self.address = address
+        self.lob_depth = lob_depth          # how many levels of each side of the LOB are in a 'lob' event
+        self.pace = pace                    # simulated seconds per wall-clock second, or None to run flat out
+        self.max_pending = max_pending
+        self.max_backlog = max_backlog
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.conns = {}                     # the open connections, indexed by connection number
+        self.n_conns = 0                    # connection numbers issued so far
+        self.traders = {}                   # connection number of each trader that's said hello, by (symbol, tid)
+        self.inbox = {}                     # messages waiting for the session, by symbol: lists of [conn, tid, msg]
+        self.inbox_lock = threading.Lock()
+        self.outbox = []                    # events queued by the session since it last flushed: [symbol, tid, event]
+        self.pace_start = None              # [wall-clock time, simulated time] when the session started keeping pace
+
+    def start(self):
+        # start serving, in a thread of its own, and wait until it's listening
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.server is None:
+            sys.exit('FAIL: gateway can\'t listen on %s' % str(self.address))
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        try:
+            if isinstance(self.address, str):
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_unix_server(self.serve, self.address, limit=2 ** 24))
+            else:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self.serve, self.address[0], self.address[1], limit=2 ** 24))
+                self.address = self.server.sockets[0].getsockname()[:2]
+        except OSError as err:
+            print('gateway: %s' % err)
+        ready.set()
+        if self.server is not None:
+            self.loop.run_forever()
+
+    def close(self):
+        # send everything still queued, then close every connection and stop serving
+        self.flush()
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def wait_clients(self, n, timeout=None):
+        # wait until n traders have said hello: returns False if timeout seconds go by first
+        t0 = chrono.monotonic()
+        while len(self.traders) < n:
+            if timeout is not None and chrono.monotonic() - t0 > timeout:
+                return False
+            chrono.sleep(0.01)
+        return True
+
+    # the session's side
+
+    def take(self, symbol):
+        # the order and cancel messages for this instrument that have come in since the last take(), oldest first,
+        # each as [connection number, tid, message]
+        if symbol not in self.inbox:
+            return []
+        with self.inbox_lock:
+            msgs = self.inbox.pop(symbol, [])
+        if len(msgs) > 0:
+            self.loop.call_soon_threadsafe(self.taken, msgs)
+        return msgs
+
+    def send(self, symbol, tid, event):
+        # queue an event for trader tid of this instrument (tid None => for every connection watching it)
+        self.outbox.append([symbol, tid, event])
+
+    def publish(self, symbol, event):
+        self.outbox.append([symbol, None, event])
+
+    def flush(self):
+        # hand everything queued since the last flush to the gateway's thread, in one go
+        if len(self.outbox) > 0:
+            self.loop.call_soon_threadsafe(self.deliver, self.outbox)
+            self.outbox = []
+
+    def keep_pace(self, time):
+        # with a pace, hold the session back so that its clock runs no faster than pace simulated seconds per second
+        if self.pace is None:
+            return
+        now = chrono.monotonic()
+        if self.pace_start is None:
+            self.pace_start = [now, time]
+        ahead = (time - self.pace_start[1]) / self.pace - (now - self.pace_start[0])
+        if ahead > 0:
+            chrono.sleep(ahead)
+
+    def end_session(self, time, symbols):
+        for symbol in symbols:
+            self.publish(symbol, {'ev': 'end', 'symbol': symbol, 'time': time})
+        self.flush()
+        self.pace_start = None
+
+    # the gateway's side
+
+    async def serve(self, reader, writer):
+        # one client connection: read its messages until it goes away, while write_events() sends it its events
+        self.n_conns += 1
+        conn = {'n': self.n_conns, 'writer': writer, 'symbol': None, 'tid': None, 'events': [], 'lobs': {},
+                'pending': 0, 'wake': asyncio.Event(), 'resume': asyncio.Event(), 'open': True, 'closing': False}
+        self.conns[conn['n']] = conn
+        conn['sender'] = asyncio.ensure_future(self.write_events(conn))
+        try:
+            while conn['open']:
+                if conn['pending'] >= self.max_pending:
+                    # back-pressure: wait for the session to catch up before reading any more
+                    conn['resume'].clear()
+                    await conn['resume'].wait()
+                    continue
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msgs = json.loads(line)
+                except ValueError:
+                    self.queue_event(conn, {'ev': 'reject', 'reason': 'bad JSON'})
+                    continue
+                if not isinstance(msgs, list):
+                    msgs = [msgs]
+                self.read_messages(conn, msgs)
+        except (ConnectionError, ValueError):
+            pass
+        self.drop(conn)
+
+    def read_messages(self, conn, msgs):
+        taken = []
+        for msg in msgs:
+            op = None
+            if isinstance(msg, dict):
+                op = msg.get('op')
+            if op == 'hello':
+                key = (msg.get('symbol'), msg.get('tid'))
+                if key in self.traders:
+                    self.queue_event(conn, {'ev': 'reject', 'reason': '%s already connected' % key[1]})
+                    continue
+                if conn['tid'] is not None:
+                    del (self.traders[(conn['symbol'], conn['tid'])])
+                [conn['symbol'], conn['tid']] = key
+                self.traders[key] = conn['n']
+                self.queue_event(conn, {'ev': 'welcome', 'symbol': key[0], 'tid': key[1]})
+            elif op == 'order' or op == 'cancel':
+                if conn['tid'] is None:
+                    self.queue_event(conn, {'ev': 'reject', 'ref': msg.get('ref'), 'reason': 'no hello'})
+                else:
+                    taken.append([conn['n'], conn['tid'], msg])
+            else:
+                self.queue_event(conn, {'ev': 'reject', 'reason': 'unknown message'})
+        if len(taken) > 0:
+            conn['pending'] += len(taken)
+            with self.inbox_lock:
+                self.inbox.setdefault(conn['symbol'], []).extend(taken)
+
+    def taken(self, msgs):
+        # the session has taken these messages: their connections can be read from again
+        for msg in msgs:
+            conn = self.conns.get(msg[0])
+            if conn is not None:
+                conn['pending'] -= 1
+                if conn['pending'] < self.max_pending:
+                    conn['resume'].set()
+
+    def deliver(self, batch):
+        for [symbol, tid, event] in batch:
+            if tid is None:
+                for conn in list(self.conns.values()):
+                    if conn['tid'] is None or conn['symbol'] == symbol:
+                        self.queue_event(conn, event, symbol)
+            else:
+                n = self.traders.get((symbol, tid))
+                if n is not None:
+                    self.queue_event(self.conns[n], event, symbol)
+
+    def queue_event(self, conn, event, symbol=None):
+        if not conn['open']:
+            return
+        if event['ev'] == 'lob':
+            # only the latest book matters
+            conn['lobs'][symbol] = event
+        else:
+            conn['events'].append(event)
+            if len(conn['events']) > self.max_backlog:
+                # this client isn't keeping up
+                self.drop(conn)
+                return
+        conn['wake'].set()
+
+    async def write_events(self, conn):
+        # send a connection's events as they're queued, everything since the last line in the next one
+        writer = conn['writer']
+        try:
+            while conn['open']:
+                await conn['wake'].wait()
+                conn['wake'].clear()
+                events = conn['events'] + list(conn['lobs'].values())
+                conn['events'] = []
+                conn['lobs'] = {}
+                if len(events) > 0:
+                    writer.write(json.dumps(events).encode() + b'\n')
+                    await writer.drain()
+                if conn['closing']:
+                    break
+        except ConnectionError:
+            pass
+        self.drop(conn)
+
+    def drop(self, conn):
+        if not conn['open']:
+            return
+        conn['open'] = False
+        del (self.conns[conn['n']])
+        if conn['tid'] is not None:
+            del (self.traders[(conn['symbol'], conn['tid'])])
+        conn['wake'].set()
+        conn['resume'].set()
+        conn['writer'].close()
+
+    async def shutdown(self):
+        self.server.close()
+        senders = []
+        for conn in list(self.conns.values()):
+            conn['closing'] = True
+            conn['wake'].set()
+            senders.append(conn['sender'])
+        if len(senders) > 0:
+            await asyncio.wait(senders, timeout=5)
+        for conn in list(self.conns.values()):
+            self.drop(conn)
+
+
 # #################--Traders below here--#############
 
 
@@ -419,6 +1828,23 @@ class Exchange(Orderbook):
 # all Traders have a trader id, bank balance, blotter, and list of orders to execute
 class Trader:
 
+    # how many price levels of each side of the LOB this type of trader needs to see (None => all of them)
+    # 0 => no levels, but the published best/worst/n/sess_hi values are always there
+    lob_depth = None
+    # the fewest levels this type of trader can work with, whatever sess_params['lob_depth'] says
+    min_lob_depth = 0
+    # with a latency model in market_session: how many seconds it takes for this trader's orders to reach the exchange,
+    # and for the LOB data published by the exchange to reach this trader
+    latency = 0.0
+    # does each new quote from this type of trader replace its previous quote on the same side of the LOB (as in BSE1.x)?
+    # False => every quote it sends stays live until it's filled or cancelled, so it can have many quotes on the LOB
+    quote_overwrites = True
+    # which market events market_session calls respond() for (see Population.responders): 'trade' => a trade,
+    # 'best' => a change to the best bid or best ask (price or quantity), 'lob' => any change to the LOB or tape,
+    # 'timer' => every one of them, for a respond() that does time-driven work
+    # none at all => respond() is never called, so a type that doesn't override it costs nothing as the market moves
+    respond_events = frozenset()
+
     def __init__(self, ttype, tid, balance, params, time):
         self.ttype = ttype          # what type / strategy this trader is
         self.tid = tid              # trader unique ID code
@@ -428,11 +1854,15 @@ class Trader:
         self.blotter_length = 100   # maximum length of blotter
         self.orders = []            # customer orders currently being worked (fixed at len=1 in BSE1.x)
         self.n_quotes = 0           # number of quotes live on LOB
+        self.quotes = {}            # the quotes live on LOB, indexed by quote i.d.
         self.birthtime = time       # used when calculating age of a trader/strategy
-        self.profitpertime = 0      # profit per unit time
+        self.ppt_value = 0          # profit per unit time, as last set (see profitpertime)
+        self.ppt_event = 0          # its Population's event count when it was set
         self.profit_mintime = 60    # minimum duration in seconds for calculating profitpertime
         self.n_trades = 0           # how many trades has this trader done?
         self.lastquote = None       # record of what its last quote was
+        self.handle = None          # index in its market's Population
+        self.population = None      # the Population it's in
 
     def __str__(self):
         return '[TID %s type %s balance %s blotter %s orders %s n_trades %s profitpertime %s]' \
@@ -442,12 +1872,14 @@ class Trader:
         # in this version, trader has at most one order,
         # if allow more than one, this needs to be self.orders.append(order)
         if self.n_quotes > 0:
-            # this trader has a live quote on the LOB, from a previous customer order
-            # need response to signal cancellation/withdrawal of that quote
+            # this trader has live quote(s) on the LOB, from a previous customer order
+            # need response to signal cancellation/withdrawal of those quotes
             response = 'LOB_Cancel'
         else:
             response = 'Proceed'
         self.orders = [order]
+        if self.population is not None:
+            self.population.touch(self)
         if verbose:
             print('add_order < response=%s' % response)
         return response
@@ -455,6 +1887,64 @@ class Trader:
     def del_order(self, order):
         # this is lazy: assumes each trader has only one customer order with quantity=1, so deleting sole order
         self.orders = []
+        if self.population is not None:
+            self.population.touch(self)
+
+    def quote_sent(self, order, live):
+        # this trader's quote has been processed by the exchange: live says whether (any of) it is now on the LOB
+        if self.quote_overwrites:
+            # the quote replaced any earlier quote on the same side of the LOB
+            for qid in [qid for qid in self.quotes if self.quotes[qid].otype == order.otype]:
+                del (self.quotes[qid])
+        if live:
+            self.quotes[order.qid] = order
+        self.n_quotes = len(self.quotes)
+
+    def quote_gone(self, qid):
+        # the quote with this quote i.d. is no longer on the LOB (it's been completely filled or it's been cancelled)
+        if qid in self.quotes:
+            del (self.quotes[qid])
+            self.n_quotes = len(self.quotes)
+
+    def unquoted_qty(self):
+        # how many units of the customer order being worked aren't already on the LOB in this trader's live quotes
+        # (a quote on the book holds its live qty, so a partly-filled quote only counts what's left of it)
+        if len(self.orders) == 0:
+            return 0
+        qty = self.orders[0].qty
+        for quote in self.quotes.values():
+            qty -= quote.qty
+        return qty
+
+    def awake(self):
+        # does calling getorder() do anything for this trader right now? (with no customer order, it just returns None)
+        # market_session's event scheduler only wakes the traders that are awake
+        return len(self.orders) > 0
+
+    def trade_profit(self, trade):
+        # profit made on a trade, relative to the limit price of the customer order being worked
+        # a trade can be for more than one unit, and a sweep record is made up of fills at different prices
+        if len(self.orders) == 0:
+            # market_session never lets a trader have more units on the LOB than its customer order has left
+            print(trade)
+            sys.exit('FAIL: trader %s has traded with no customer order to work' % self.tid)
+        if 'fills' in trade:
+            fills = trade['fills']
+        else:
+            fills = [trade]
+        profit = 0
+        for fill in fills:
+            if self.orders[0].otype == 'Bid':
+                profit += (self.orders[0].price - fill['price']) * fill['qty']
+            else:
+                profit += (fill['price'] - self.orders[0].price) * fill['qty']
+        return profit
+
+    def trade_done(self, trade, order):
+        # the customer order has had trade['qty'] units filled: it's finished with once there are none left
+        self.orders[0].qty -= trade['qty']
+        if self.orders[0].qty <= 0:
+            self.del_order(order)
 
     def profitpertime_update(self, time, birthtime, totalprofit):
         time_alive = (time - birthtime)
@@ -474,12 +1964,7 @@ class Trader:
         self.blotter.append(trade)  # add trade record to trader's blotter
         self.blotter = self.blotter[-self.blotter_length:]  # right-truncate to keep to length
 
-        # NB What follows is **LAZY** -- assumes all orders are quantity=1
-        transactionprice = trade['price']
-        if self.orders[0].otype == 'Bid':
-            profit = self.orders[0].price - transactionprice
-        else:
-            profit = transactionprice - self.orders[0].price
+        profit = self.trade_profit(trade)
         self.balance += profit
         self.n_trades += 1
         self.profitpertime = self.balance / (time - self.birthtime)
@@ -492,7 +1977,7 @@ class Trader:
 
         if verbose:
             print('%s profit=%d balance=%d profit/time=%s' % (outstr, profit, self.balance, str(self.profitpertime)))
-        self.del_order(order)  # delete the order
+        self.trade_done(trade, order)  # delete the order, if it has been completely filled
 
         # if the trader has multiple strategies (e.g. PRSH/PRDE/ZIPSH/ZIPDE) then there is more work to do...
         if hasattr(self, 'strats') and self.strats is not None:
@@ -501,10 +1986,26 @@ class Trader:
             birthtime = self.strats[self.active_strat]['start_t']
             self.strats[self.active_strat]['pps'] = self.profitpertime_update(time, birthtime, totalprofit)
 
-    # specify how trader responds to events in the market
+    # profit per unit time
+    # Trader's own respond() used to update this every time the market moved, and that was all it did, so now it's
+    # worked out when it's read instead: for a trader that doesn't override respond(), once its market has had an
+    # event since the value was last set (e.g. by bookkeep()), it's as of the time of that market's latest event
+    @property
+    def profitpertime(self):
+        population = self.population
+        if population is not None and population.n_events > self.ppt_event and type(self).respond is Trader.respond:
+            return self.profitpertime_update(population.time, self.birthtime, self.balance)
+        return self.ppt_value
+
+    @profitpertime.setter
+    def profitpertime(self, value):
+        self.ppt_value = value
+        if self.population is not None:
+            self.ppt_event = self.population.n_events
+
+    # specify how trader responds to events in the market (the ones named in respond_events)
     # this is a null action, expect it to be overloaded by specific algos
     def respond(self, time, lob, trade, verbose):
-        # any trader subclass with custom respond() must include this update of profitpertime
         self.profitpertime = self.profitpertime_update(time, self.birthtime, self.balance)
         return None
 
@@ -519,6 +2020,8 @@ class Trader:
 # (but never makes a loss)
 class Trader_Giveaway(Trader):
 
+    lob_depth = 0
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             order = None
@@ -537,6 +2040,8 @@ class Trader_Giveaway(Trader):
 # After Gode & Sunder 1993
 class Trader_ZIC(Trader):
 
+    lob_depth = 0
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             # no orders: return NULL
@@ -562,6 +2067,8 @@ class Trader_ZIC(Trader):
 # if there is no best price, creates "stub quote" at system max/min
 class Trader_Shaver(Trader):
 
+    lob_depth = 0
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             order = None
@@ -593,6 +2100,8 @@ class Trader_Shaver(Trader):
 # then gets increasing aggressive, increasing "shave thickness" as time runs out
 class Trader_Sniper(Trader):
 
+    lob_depth = 0
+
     def getorder(self, time, countdown, lob):
         lurk_threshold = 0.2
         shavegrowthrate = 3
@@ -636,6 +2145,10 @@ class Trader_Sniper(Trader):
 
 class Trader_PRZI(Trader):
 
+    lob_depth = 0
+    # PRSH and PRDE switch strategies after so long, and every PRZI keeps its strategies' profit-per-second up to date
+    respond_events = frozenset(['timer'])
+
     # return strategy as a csv-format string (trivial in PRZI, but other traders with more complex strategies need this)
     def strat_csv_str(self, strat):
         csv_str = 's=,%+5.3f, ' % strat
@@ -1041,12 +2554,7 @@ class Trader_PRZI(Trader):
         self.blotter.append(trade)  # add trade record to trader's blotter
         self.blotter = self.blotter[-self.blotter_length:]      # right-truncate to keep to length
 
-        # NB What follows is **LAZY** -- assumes all orders are quantity=1
-        transactionprice = trade['price']
-        if self.orders[0].otype == 'Bid':
-            profit = self.orders[0].price - transactionprice
-        else:
-            profit = transactionprice - self.orders[0].price
+        profit = self.trade_profit(trade)
         self.balance += profit
         self.n_trades += 1
         self.profitpertime = self.balance / (time - self.birthtime)
@@ -1059,7 +2567,7 @@ class Trader_PRZI(Trader):
 
         if verbose:
             print('%s profit=%d balance=%d profit/time=%d' % (outstr, profit, self.balance, self.profitpertime))
-        self.del_order(order)  # delete the order
+        self.trade_done(trade, order)  # delete the order, if it has been completely filled
 
         self.strats[self.active_strat]['profit'] += profit
         time_alive = time - self.strats[self.active_strat]['start_t']
@@ -1324,6 +2832,13 @@ class Trader_ZIP(Trader):
     #    so a single trader can both buy AND sell
     #    -- in the original, traders were either buyers OR sellers
 
+    # ZIP looks at the quantity at the best bid and best ask
+    lob_depth = 1
+    min_lob_depth = 1
+    # vanilla ZIP only alters its margin when there's been a trade or the best bid or ask has changed
+    # (ZIPSH's optimizer also switches strategies after so long, so it responds to everything: see __init__)
+    respond_events = frozenset(['trade', 'best'])
+
     # take a ZIP strategy vector and return it as a csv-format string
     def strat_csv_str(self, strat):
         if strat is None:
@@ -1441,6 +2956,8 @@ class Trader_ZIP(Trader):
         # the following set of variables are needed only by ZIP with added hyperparameter optimization (e.g. ZIPSH)
         self.k = k                  # how many strategies evaluated at any one time?
         self.optmzr = optimizer     # what form of strategy-optimizer we're using
+        if optimizer is not None:
+            self.respond_events = frozenset(['timer'])
         self.strats = None          # the list of strategies, each of which is a dictionary
         self.strat_wait_time = init_stratwaittime()     # how many secs do we give any one strat before switching?
         self.strat_eval_time = self.k * self.strat_wait_time  # time to cycle through evaluating all k strategies
@@ -1472,6 +2989,10 @@ class Trader_ZIP(Trader):
             for s in self.strats:
                 self.logfile.write(str(s)+'\n')
 
+    def awake(self):
+        # a trader that's finished its customer order is still active until getorder() notices
+        return len(self.orders) > 0 or self.active
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             self.active = False
@@ -1700,13 +3221,18 @@ class Trader_ZIP(Trader):
         lob_best_bid_q = None
         if lob_best_bid_p is not None:
             # non-empty bid LOB
-            lob_best_bid_q = lob['bids']['lob'][-1][1]
+            if len(lob['bids']['lob']) > 0:
+                lob_best_bid_q = lob['bids']['lob'][-1][1]
+            else:
+                # no levels published: take it that the quantity there hasn't changed
+                lob_best_bid_q = self.prev_best_bid_q
             if (self.prev_best_bid_p is not None) and (self.prev_best_bid_p < lob_best_bid_p):
                 # best bid has improved
                 # NB doesn't check if the improvement was by self
                 bid_improved = True
             elif trade is not None and ((self.prev_best_bid_p > lob_best_bid_p) or (
-                    (self.prev_best_bid_p == lob_best_bid_p) and (self.prev_best_bid_q > lob_best_bid_q))):
+                    (self.prev_best_bid_p == lob_best_bid_p) and (self.prev_best_bid_q is not None) and
+                    (self.prev_best_bid_q > lob_best_bid_q))):
                 # previous best bid was hit
                 bid_hit = True
         elif self.prev_best_bid_p is not None:
@@ -1724,12 +3250,17 @@ class Trader_ZIP(Trader):
         lob_best_ask_q = None
         if lob_best_ask_p is not None:
             # non-empty ask LOB
-            lob_best_ask_q = lob['asks']['lob'][0][1]
+            if len(lob['asks']['lob']) > 0:
+                lob_best_ask_q = lob['asks']['lob'][0][1]
+            else:
+                # no levels published: take it that the quantity there hasn't changed
+                lob_best_ask_q = self.prev_best_ask_q
             if (self.prev_best_ask_p is not None) and (self.prev_best_ask_p > lob_best_ask_p):
                 # best ask has improved -- NB doesn't check if the improvement was by self
                 ask_improved = True
             elif trade is not None and ((self.prev_best_ask_p < lob_best_ask_p) or (
-                    (self.prev_best_ask_p == lob_best_ask_p) and (self.prev_best_ask_q > lob_best_ask_q))):
+                    (self.prev_best_ask_p == lob_best_ask_p) and (self.prev_best_ask_q is not None) and
+                    (self.prev_best_ask_q > lob_best_ask_q))):
                 # trade happened and best ask price has got worse, or stayed same but quantity reduced
                 # -- assume previous best ask was lifted
                 ask_lifted = True
@@ -1797,6 +3328,90 @@ class Trader_ZIP(Trader):
         # return value of respond() tells caller whether to print a new frame of system-snapshot data
         return snapshot
 
+
+# Trader subclass Remote
+# stands in the population for a trader that runs as a separate process, connected through an Exchange_gateway:
+# its quotes and cancels come from that process, not from getorder(), and everything that happens to it is sent back
+class Trader_Remote(Trader):
+
+    lob_depth = 0
+
+    def __init__(self, ttype, tid, balance, params, time):
+        Trader.__init__(self, ttype, tid, balance, params, time)
+        self.gateway = None         # the Exchange_gateway it's connected through, set by market_session
+        self.symbol = None          # which instrument it trades
+        self.refs = {}              # the client's ref for each of its orders not yet processed by the exchange
+
+    def notify(self, event):
+        if self.gateway is not None:
+            self.gateway.send(self.symbol, self.tid, event)
+
+    def getorder(self, time, countdown, lob):
+        # its quotes come through the gateway instead
+        return None
+
+    def remote_order(self, time, msg, qid):
+        # the Order for a quote message from the client, or None (with a reject sent back) if it won't do:
+        # like a robot's quote, it has to be for the customer order being worked, at a price within its limit
+        otype = msg.get('otype')
+        price = msg.get('price')
+        qty = msg.get('qty', 1)
+        reason = None
+        if len(self.orders) < 1:
+            reason = 'no customer order'
+        elif otype != self.orders[0].otype:
+            reason = 'customer order is %s' % self.orders[0].otype
+        elif type(price) is not int or not bse_sys_minprice <= price <= bse_sys_maxprice:
+            reason = 'bad price'
+        elif type(qty) is not int or not 0 < qty <= self.orders[0].qty:
+            reason = 'bad qty'
+        elif (otype == 'Bid' and price > self.orders[0].price) or (otype == 'Ask' and price < self.orders[0].price):
+            reason = 'beyond limit price'
+        if reason is not None:
+            self.notify({'ev': 'reject', 'ref': msg.get('ref'), 'reason': reason})
+            return None
+        order = Order(self.tid, otype, price, qty, time, qid)
+        self.refs[order] = msg.get('ref')
+        self.lastquote = order
+        return order
+
+    def quote_rejected(self, order, reason):
+        self.notify({'ev': 'reject', 'ref': self.refs.pop(order, None), 'reason': reason})
+
+    def quote_sent(self, order, live):
+        Trader.quote_sent(self, order, live)
+        self.notify({'ev': 'ack', 'ref': self.refs.pop(order, None), 'qid': order.qid, 'live': live})
+
+    def quote_gone(self, qid):
+        if qid in self.quotes:
+            self.notify({'ev': 'gone', 'qid': qid})
+        Trader.quote_gone(self, qid)
+
+    def add_order(self, order, verbose):
+        response = Trader.add_order(self, order, verbose)
+        self.notify({'ev': 'assign', 'time': order.time, 'otype': order.otype, 'price': order.price,
+                     'qty': order.qty})
+        return response
+
+    def del_order(self, order):
+        Trader.del_order(self, order)
+        self.notify({'ev': 'done'})
+
+    def bookkeep(self, trade, order, verbose, time):
+        profit = self.trade_profit(trade)
+        if trade['party2'] == self.tid:
+            qid = trade['qid2']
+        else:
+            qid = trade['qid1']
+        if 'fills' in trade:
+            fills = [[fill['price'], fill['qty']] for fill in trade['fills']]
+        else:
+            fills = [[trade['price'], trade['qty']]]
+        Trader.bookkeep(self, trade, order, verbose, time)
+        self.notify({'ev': 'fill', 'time': time, 'qid': qid, 'fills': fills, 'profit': profit,
+                     'balance': self.balance})
+
+
 # ########################---trader-types have all been defined now--################
 
 
@@ -1847,8 +3462,126 @@ def trade_stats(expid, traders, dumpfile, time, lob):
     dumpfile.write('\n')
 
 
+# Population holds a market's traders in a list indexed by integer handle: 0 .. n_buyers-1 are the buyers and the
+# rest the sellers, in the order of their Trader IDs, so picking a trader at random or visiting them all needs no
+# dictionary lookups and no new list; the Trader ID strings ('B07', 'S13') are only for the book, tape, and output
+# with track_awake, it also keeps the set of awake traders (see Trader.awake) for market_session's event schedulers,
+# as a list of handles with each one's position in it in awake_at, so a trader can be added, removed, or picked at
+# random in O(1): a trader whose customer orders change adds itself to touched, and sync() brings the set up to date
+# for just those
+# it also works out which of its traders to call respond() on when the market moves: each trader type names the
+# events it cares about in respond_events, and responders() says which of those have happened since it was last
+# called and gives the traders that subscribe to any of them, in handle order, from a list made once for each mix
+class Population:
+
+    def __init__(self, traders, track_awake=False):
+        self.traders = list(traders.values())   # NB traders is populate_market's dictionary, in Trader ID order
+        self.track_awake = track_awake
+        self.awake = []
+        self.awake_at = [None] * len(self.traders)
+        self.touched = []
+        self.n_events = 0           # how many times responders() has been called
+        self.time = None            # the time of the latest of them (see Trader.profitpertime)
+        self.lob_version = None     # the LOB's version then
+        self.best = [None, None, None, None]    # and its best bid price & quantity, best ask price & quantity
+        self.subscribers = {}       # the traders that respond to each mix of events, indexed by the tuple of events
+        self.latency_subscribers = {}   # and the same split up by latency (see responders_by_latency)
+        for handle in range(len(self.traders)):
+            self.traders[handle].handle = handle
+            self.traders[handle].population = self
+            if track_awake:
+                self.touched.append(self.traders[handle])
+        self.sync()
+
+    def __len__(self):
+        return len(self.traders)
+
+    def __getitem__(self, handle):
+        return self.traders[handle]
+
+    def __iter__(self):
+        return iter(self.traders)
+
+    def pick(self):
+        # a trader chosen at random
+        return self.traders[random.randint(0, len(self.traders) - 1)]
+
+    def pick_awake(self):
+        # an awake trader chosen at random (call sync() first)
+        return self.traders[self.awake[random.randint(0, len(self.awake) - 1)]]
+
+    def n_awake(self):
+        return len(self.awake)
+
+    def touch(self, trader):
+        if self.track_awake:
+            self.touched.append(trader)
+
+    def events(self, time, lob, trade):
+        # which events have happened in the market since last time, now that it's published lob after trade (or None)
+        self.n_events += 1
+        self.time = time
+        events = ['timer']
+        if trade is not None:
+            events.append('trade')
+        if lob['version'] != self.lob_version:
+            self.lob_version = lob['version']
+            events.append('lob')
+            best = [lob['bids']['best'], None, lob['asks']['best'], None]
+            if best[0] is not None and len(lob['bids']['lob']) > 0:
+                best[1] = lob['bids']['lob'][-1][1]
+            if best[2] is not None and len(lob['asks']['lob']) > 0:
+                best[3] = lob['asks']['lob'][0][1]
+            if best != self.best:
+                self.best = best
+                events.append('best')
+        return tuple(events)
+
+    def responders(self, time, lob, trade):
+        # the traders to call respond() on, in handle order
+        return self.subscribed(self.events(time, lob, trade))
+
+    def subscribed(self, events):
+        subscribers = self.subscribers.get(events)
+        if subscribers is None:
+            subscribers = [trader for trader in self.traders if not trader.respond_events.isdisjoint(events)]
+            self.subscribers[events] = subscribers
+        return subscribers
+
+    def responders_by_latency(self, time, lob, trade):
+        # for the latency model: a list of [latency, the traders with that latency to call respond() on], with an
+        # entry for every latency any trader has (even if none of its traders respond), lowest latency first
+        # NB the traders' latencies are taken as fixed once this has first been called
+        events = self.events(time, lob, trade)
+        groups = self.latency_subscribers.get(events)
+        if groups is None:
+            latencies = sorted(set([trader.latency for trader in self.traders]))
+            groups = [[latency, []] for latency in latencies]
+            for trader in self.subscribed(events):
+                groups[latencies.index(trader.latency)][1].append(trader)
+            self.latency_subscribers[events] = groups
+        return groups
+
+    def sync(self):
+        for trader in self.touched:
+            handle = trader.handle
+            at = self.awake_at[handle]
+            if trader.awake():
+                if at is None:
+                    self.awake_at[handle] = len(self.awake)
+                    self.awake.append(handle)
+            elif at is not None:
+                # move the last one into its place
+                last = self.awake.pop()
+                if last != handle:
+                    self.awake[at] = last
+                    self.awake_at[last] = at
+                self.awake_at[handle] = None
+        self.touched = []
+
+
 # create a bunch of traders from traders_spec
-# returns tuple (n_buyers, n_sellers)
+# returns dict of n_buyers, n_sellers, and the Trader IDs of each
 # optionally shuffles the pack of buyers and the pack of sellers
 def populate_market(traders_spec, traders, shuffle, verbose):
     # traders_spec is a list of buyer-specs and a list of seller-specs
@@ -1875,6 +3608,8 @@ def populate_market(traders_spec, traders, shuffle, verbose):
             return Trader_PRZI('PRSH', name, balance, parameters, time0)
         elif robottype == 'PRDE':
             return Trader_PRZI('PRDE', name, balance, parameters, time0)
+        elif robottype == 'REMOTE':
+            return Trader_Remote('REMOTE', name, balance, parameters, time0)
         else:
             sys.exit('FATAL: don\'t know robot type %s\n' % robottype)
 
@@ -1978,11 +3713,15 @@ def populate_market(traders_spec, traders, shuffle, verbose):
 # parameter "os" is order schedule
 # os['timemode'] is either 'periodic', 'drip-fixed', 'drip-jitter', or 'drip-poisson'
 # os['interval'] is number of seconds for a full cycle of replenishment
+# os['qty'] is optional: the number of units in each customer order (default 1)
 # drip-poisson sequences will be normalised to ensure time of last replenishment <= interval
-# parameter "pending" is the list of future orders (if this is empty, generates a new one from os)
+# parameter "traders" is the market's Population: buyer t is traders[t], and seller t is traders[n_buyers + t]
+# parameter "pending" is an Event_queue of future orders, keyed on issue time (if it's empty, generates a new one
+# from os), each held as [trader, order]: only the orders that are due get popped off it, in the order they were
+# generated, and each goes straight to its trader
 # revised "pending" is the returned value
 #
-# also returns a list of "cancellations": trader-ids for those traders who are now working a new order and hence
+# also returns a list of "cancellations": the traders who are now working a new order and hence
 # need to kill quotes already on LOB from working previous order
 #
 #
@@ -2118,11 +3857,13 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
 
     shuffle_times = True
 
+    order_qty = os.get('qty', 1)
+
     cancellations = []
 
     if len(pending) < 1:
-        # list of pending (to-be-issued) customer orders is empty, so generate a new one
-        new_pending = []
+        # queue of pending (to-be-issued) customer orders is empty, so generate a new one
+        new_pending = Event_queue()
 
         # demand side (buyers)
         issuetimes = getissuetimes(n_buyers, os['timemode'], os['interval'], shuffle_times, True)
@@ -2131,10 +3872,10 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
         (sched, mode) = getschedmode(time, os['dem'])
         for t in range(n_buyers):
             issuetime = time + issuetimes[t]
-            tname = 'B%02d' % t
+            trader = traders[t]
             orderprice = getorderprice(t, sched, n_buyers, mode, issuetime)
-            order = Order(tname, ordertype, orderprice, 1, issuetime, chrono.time())
-            new_pending.append(order)
+            order = Order(trader.tid, ordertype, orderprice, order_qty, issuetime, chrono.time())
+            new_pending.push(issuetime, [trader, order])
 
         # supply side (sellers)
         issuetimes = getissuetimes(n_sellers, os['timemode'], os['interval'], shuffle_times, True)
@@ -2142,35 +3883,78 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
         (sched, mode) = getschedmode(time, os['sup'])
         for t in range(n_sellers):
             issuetime = time + issuetimes[t]
-            tname = 'S%02d' % t
+            trader = traders[n_buyers + t]
             orderprice = getorderprice(t, sched, n_sellers, mode, issuetime)
             # print('time %d sellerprice %d' % (time,orderprice))
-            order = Order(tname, ordertype, orderprice, 1, issuetime, chrono.time())
-            new_pending.append(order)
+            order = Order(trader.tid, ordertype, orderprice, order_qty, issuetime, chrono.time())
+            new_pending.push(issuetime, [trader, order])
     else:
         # there are pending future orders: issue any whose timestamp is in the past
-        new_pending = []
-        for order in pending:
-            if order.time < time:
-                # this order should have been issued by now
-                # issue it to the trader
-                tname = order.tid
-                response = traders[tname].add_order(order, verbose)
+        new_pending = pending
+        for [trader, order] in pending.pop_before(time):
+            # this order should have been issued by now
+            # issue it to the trader
+            response = trader.add_order(order, verbose)
+            if verbose:
+                print('Customer order: %s %s' % (response, order))
+            if response == 'LOB_Cancel':
+                cancellations.append(trader)
                 if verbose:
-                    print('Customer order: %s %s' % (response, order))
-                if response == 'LOB_Cancel':
-                    cancellations.append(tname)
-                    if verbose:
-                        print('Cancellations: %s' % cancellations)
-                # and then don't add it to new_pending (i.e., delete it)
-            else:
-                # this order stays on the pending list
-                new_pending.append(order)
+                    print('Cancellations: %s' % [kill.tid for kill in cancellations])
+            # the rest stay on the pending queue
     return [new_pending, cancellations]
 
 
 # one session in the market
-def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dump_flags, verbose):
+# sess_params is an optional dictionary of extra settings for the session:
+#   'lob_type': how the exchange holds its orderbook, 'dict' (default) or 'ladder'
+#   'lob_depth': how many LOB price levels are published to every trader;
+#                if not given, each trader is shown as many as its trader-type asks for (Trader.lob_depth);
+#                either way, never fewer than its trader-type needs (Trader.min_lob_depth)
+#   'symbols': list of the instruments traded in the session, if there's more than one;
+#              then trader_spec and order_schedule are dictionaries indexed by symbol, giving each instrument's
+#              traders and customer orders, and each instrument's output files have the symbol added to sess_id
+#   'seeds': dictionary indexed by symbol of random-number seeds for each instrument (if not given, they're random)
+#   'auction_interval': if given, the exchange runs frequent batch auctions rather than continuous matching:
+#                       orders wait on the book, and every auction_interval seconds it's cleared in one call auction
+#   'lob_frames': 'csv' (default) or 'binary', the format of the LOB frames file written if dump_flags['dump_lobs']
+#                 is True: 'binary' writes a LOB_frame_writer file, _LOB_frames.bin, of deltas and keyframes
+#   'latency': switches on the latency model, where orders reach the exchange, and the LOB data it publishes reaches
+#              the traders, after a delay: either one number of seconds for every trader, or a dictionary of them
+#              indexed by Trader ID (any trader not in it keeps its Trader.latency); the orders and publications are
+#              timestamped events, handled in time order from a heap (Event_queue)
+#   'fork_time' and 'branches': when the session reaches fork_time it forks a child process for each branch (a list of
+#                               functions); each child calls its function with a dictionary of the session's state
+#                               ('time', 'branch' number from 1 up, 'exchange', 'markets'), which it may change, then
+#                               carries on to endtime, with '_b01' etc. added to its sess_id; the parent carries on as
+#                               it was and waits for the children at the end
+#                               the children share the parent's state through the OS's copy-on-write of the process,
+#                               so nothing is copied unless a branch changes it
+#   'gateway': a started Exchange_gateway, through which the session's REMOTE traders are run by other processes;
+#              the gateway streams the session's LOB and trades to every client, and can keep the session to a pace
+#              (NB not with 'fork_time'/'branches', and not in sharded_market_session, as it runs in its own thread)
+#   'scheduler': 'timestep' (default) steps every market on by a fixed timestep (1 / the number of traders) and asks
+#                one trader chosen at random for an order at every step; 'events' jumps straight from one event to
+#                the next, waking traders in continuous time, and 'events-timestep' does the same but keeps every
+#                event on the timestep grid, so it has the same statistics as 'timestep' (see next_event());
+#                either way, quiet periods with nobody working a customer order take no time at all
+#   'index_bucket': the tape and LOB frames files are written with a sidecar Time_index (fname + '.idx') of the byte
+#                   offset of the first record in each index_bucket seconds of the session (default 60), so that
+#                   load_window() or LOB_frame_reader can read just the slice for a time window; None for no index
+#   'tape_archive': with dump_flags['dump_tape'], every tape event is archived in sess_id + '_tape_archive.csv' as the
+#                   session runs, so the tape dump has every trade however long the session; that file (which also
+#                   has the cancellations) is deleted once the tape's been dumped unless this is True (default False)
+# dump_flags['dump_journal'] is optional: if True, everything the exchange accepts is journalled (see replay_journal)
+def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dump_flags, verbose, sess_params=None):
+
+    def deepest(depths):
+        # the depth that satisfies all of the given depths (None => full depth)
+        deepest_depth = 0
+        for depth in depths:
+            if depth is None:
+                return None
+            deepest_depth = max(deepest_depth, depth)
+        return deepest_depth
 
     def dump_strats_frame(time, stratfile, trdrs):
         # write one frame of strategy snapshot
@@ -2185,7 +3969,7 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
         best_seller_strat = None
 
         # loop through traders to find the best
-        for t in traders:
+        for t in trdrs:
             trader = trdrs[t]
 
             # print('PRSH/PRDE/ZIPSH strategy recording, t=%s' % trader)
@@ -2221,11 +4005,11 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
 
         if best_buyer_id is not None:
             line_str += 'best_B_id=,%s, best_B_prof=,%f, best_B_strat=, ' % (best_buyer_id, best_buyer_prof)
-            line_str += traders[best_buyer_id].strat_csv_str(best_buyer_strat)
+            line_str += trdrs[best_buyer_id].strat_csv_str(best_buyer_strat)
 
         if best_seller_id is not None:
             line_str += 'best_S_id=,%s, best_S_prof=,%f, best_S_strat=, ' % (best_seller_id, best_seller_prof)
-            line_str += traders[best_seller_id].strat_csv_str(best_seller_strat)
+            line_str += trdrs[best_seller_id].strat_csv_str(best_seller_strat)
 
         line_str += '\n'
 
@@ -2251,47 +4035,422 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
     bookkeep_verbose = False
     populate_verbose = False
 
-    if dump_flags['dump_strats']:
-        strat_dump = open(sess_id + '_strats.csv', 'w')
+    if sess_params is None:
+        sess_params = {}
+
+    # which instruments are traded in this session?
+    # with no 'symbols' there's just one instrument, and trader_spec and order_schedule are for that;
+    # otherwise trader_spec and order_schedule are dictionaries indexed by symbol
+    symbols = sess_params.get('symbols')
+    if symbols is None:
+        multi = False
+        symbols = [None]
+        trader_specs = {None: trader_spec}
+        order_schedules = {None: order_schedule}
     else:
-        strat_dump = None
+        multi = True
+        trader_specs = trader_spec
+        order_schedules = order_schedule
+        seeds = sess_params.get('seeds')
+        if seeds is None:
+            seeds = {}
+            for symbol in symbols:
+                seeds[symbol] = random.randrange(2 ** 32)
 
-    if dump_flags['dump_lobs']:
-        lobframes = open(sess_id + '_LOB_frames.csv', 'w')
-    else:
-        lobframes = None
+    # initialise the exchange
+    exchange = Exchange_multi(symbols, sess_params.get('lob_type', 'dict'))
+    auction_interval = sess_params.get('auction_interval')
+    latency = sess_params.get('latency')
+    index_bucket = sess_params.get('index_bucket', 60)
+    keep_tape_archive = sess_params.get('tape_archive', False)
+    gateway = sess_params.get('gateway')
+    scheduler = sess_params.get('scheduler', 'timestep')
+    if scheduler not in ['timestep', 'events', 'events-timestep']:
+        sys.exit('FAIL: unknown scheduler %s' % scheduler)
+
+    def new_market(symbol):
+        # everything that's kept for one instrument: its own population of traders, its own customer orders,
+        # its own clock, and (if there's more than one instrument) its own random-number state,
+        # so what happens in one market doesn't depend on which other markets are in the same session
+        market = {'symbol': symbol}
+        if multi:
+            random.seed(seeds[symbol])
+            market['sess_id'] = '%s_%s' % (sess_id, symbol)
+        else:
+            market['sess_id'] = sess_id
 
-    if dump_flags['dump_avgbals']:
-        avg_bals = open(sess_id + '_avg_balance.csv', 'w')
-    else:
-        avg_bals = None
+        if dump_flags['dump_strats']:
+            market['strat_dump'] = open(market['sess_id'] + '_strats.csv', 'w')
+        else:
+            market['strat_dump'] = None
 
-    # initialise the exchange
-    exchange = Exchange()
+        if dump_flags['dump_lobs']:
+            if sess_params.get('lob_frames', 'csv') == 'binary':
+                market['lobframes'] = LOB_frame_writer(market['sess_id'] + '_LOB_frames.bin',
+                                                       index_bucket=index_bucket)
+            else:
+                market['lobframes'] = open(market['sess_id'] + '_LOB_frames.csv', 'w')
+                if index_bucket is not None:
+                    exchange[symbol].lob_index = Time_index(market['lobframes'].name, index_bucket)
+        else:
+            market['lobframes'] = None
 
-    # create a bunch of traders
-    traders = {}
-    trader_stats = populate_market(trader_spec, traders, True, populate_verbose)
+        if dump_flags['dump_avgbals']:
+            market['avg_bals'] = open(market['sess_id'] + '_avg_balance.csv', 'w')
+        else:
+            market['avg_bals'] = None
 
-    # timestep set so that can process all traders in one second
-    # NB minimum interarrival time of customer orders may be much less than this!!
-    timestep = 1.0 / float(trader_stats['n_buyers'] + trader_stats['n_sellers'])
+        if dump_flags['dump_tape']:
+            # keep every tape event on disk, so the tape dump has the whole session's trades
+            exchange.archive_tape(symbol, market['sess_id'] + '_tape_archive.csv')
 
-    duration = float(endtime - starttime)
+        if dump_flags.get('dump_journal', False):
+            # journal everything the exchange accepts, so the session's book can be rebuilt with replay_journal()
+            exchange.start_journal(symbol, market['sess_id'] + '_journal.csv')
 
-    last_update = -1.0
+        # create a bunch of traders
+        traders = {}
+        trader_stats = populate_market(trader_specs[symbol], traders, True, populate_verbose)
+        market['traders'] = traders
+        market['trader_stats'] = trader_stats
 
-    time = starttime
+        # how deep a view of the LOB does each trader get?
+        if 'lob_depth' in sess_params:
+            for t in traders:
+                if sess_params['lob_depth'] is None:
+                    traders[t].lob_depth = None
+                else:
+                    traders[t].lob_depth = max(sess_params['lob_depth'], traders[t].min_lob_depth)
+        # everyone responds to the same published LOB, so that has to be deep enough for all of them
+        market['respond_depth'] = deepest([traders[t].lob_depth for t in traders])
 
-    pending_cust_orders = []
+        # the same traders, indexed by handle
+        market['population'] = Population(traders, scheduler != 'timestep')
 
-    if verbose:
-        print('\n%s;  ' % sess_id)
+        # REMOTE traders are run by other processes, through the gateway
+        for t in traders:
+            if isinstance(traders[t], Trader_Remote):
+                if gateway is None:
+                    sys.exit('FAIL: REMOTE traders need sess_params[\'gateway\']')
+                traders[t].gateway = gateway
+                traders[t].symbol = symbol
+        market['gateway_seq'] = 0           # tape sequence number of the last trade streamed through the gateway
+        market['gateway_version'] = None    # lob_version of the last LOB streamed through the gateway
+
+        # timestep set so that can process all traders in one second
+        # NB minimum interarrival time of customer orders may be much less than this!!
+        market['timestep'] = 1.0 / float(trader_stats['n_buyers'] + trader_stats['n_sellers'])
+
+        market['time'] = starttime
+        market['step'] = 0                  # with the 'events-timestep' scheduler, how many timesteps in it is
+        market['wake'] = [None, 0]          # with an event scheduler, when the next trader wakes (see woken_trader)
+
+        if auction_interval is not None:
+            market['next_auction'] = starttime + auction_interval
+
+        if latency is not None:
+            # every order and every LOB publication is an event that happens after the latency of the trader concerned
+            for t in traders:
+                if isinstance(latency, dict):
+                    traders[t].latency = latency.get(t, traders[t].latency)
+                else:
+                    traders[t].latency = latency
+            market['events'] = Event_queue()
+            # the LOB data last published to the traders with each latency (all of them see the same publications),
+            # indexed by latency: missing until there's been some
+            market['lobs_seen'] = {}
+
+        market['pending_cust_orders'] = Event_queue()
 
-    # frames_done is record of what frames we have printed data for thus far
-    frames_done = set()
+        # frames_done is record of what frames we have printed data for thus far
+        market['frames_done'] = set()
 
-    while time < endtime:
+        if multi:
+            market['random_state'] = random.getstate()
+
+        return market
+
+    def send_order(market, time, trader, order):
+        # the exchange processes an order from this trader, and if it trades the counterparties bookkeep it
+        # returns the trade, or None
+        symbol = market['symbol']
+        traders = market['traders']
+        trade = None
+        if not trader.quote_overwrites and order.qty > trader.unquoted_qty():
+            # a trader that keeps many quotes live can only quote the units of its customer order that aren't on the
+            # LOB already: otherwise once the customer order was filled and finished with, its other quotes would
+            # still be there to trade, with no customer order to book the trades against
+            if trader.unquoted_qty() <= 0:
+                if isinstance(trader, Trader_Remote):
+                    trader.quote_rejected(order, 'customer order already quoted in full')
+                if verbose:
+                    print('%s order from %s is more than its customer order has left: %s'
+                          % (market['sess_id'], trader.tid, order))
+                return None
+            order.qty = trader.unquoted_qty()
+        if auction_interval is None:
+            trade = exchange.process_order2(time, symbol, order, process_verbose, trader.quote_overwrites)
+            trader.quote_sent(order, exchange.quote_live(symbol, order.qid))
+        else:
+            # batch-auction mode: the order goes on the book to wait for the next auction
+            exchange.add_order(time, symbol, order, process_verbose, trader.quote_overwrites)
+            trader.quote_sent(order, True)
+        if trade is not None:
+            # trade occurred,
+            # so the counterparties update order lists and blotters
+            # (the exchange only knows them by Trader ID, from the quotes on its book)
+            # (an order that swept through several orders on the book gives one report, listing each fill)
+            if 'fills' in trade:
+                fills = trade['fills']
+            else:
+                fills = [trade]
+            for fill in fills:
+                if not exchange.quote_live(symbol, fill['qid1']):
+                    traders[fill['party1']].quote_gone(fill['qid1'])
+                traders[fill['party1']].bookkeep(fill, order, bookkeep_verbose, time)
+            traders[trade['party2']].bookkeep(trade, order, bookkeep_verbose, time)
+            if dump_flags['dump_avgbals']:
+                trade_stats(market['sess_id'], traders, market['avg_bals'], time,
+                            exchange.publish_lob(time, symbol, market['lobframes'], lob_verbose, 0))
+        return trade
+
+    def run_auction(market, time):
+        # time for an auction: every trade is between a buyer (party1) and a seller (party2), and both bookkeep it
+        # returns the last of the trades, or None if there weren't any
+        symbol = market['symbol']
+        traders = market['traders']
+        market['next_auction'] += auction_interval
+        auction_trades = exchange.clear_auction(time, symbol, process_verbose)
+        for auction_trade in auction_trades:
+            for party, qid in [[auction_trade['party1'], auction_trade['qid1']],
+                               [auction_trade['party2'], auction_trade['qid2']]]:
+                if not exchange.quote_live(symbol, qid):
+                    traders[party].quote_gone(qid)
+                traders[party].bookkeep(auction_trade, None, bookkeep_verbose, time)
+        if len(auction_trades) == 0:
+            return None
+        if dump_flags['dump_avgbals']:
+            trade_stats(market['sess_id'], traders, market['avg_bals'], time,
+                        exchange.publish_lob(time, symbol, market['lobframes'], lob_verbose, 0))
+        # the trades are all at the same price, so the last one stands for them all when traders respond
+        return auction_trades[-1]
+
+    def respond_all(market, time, trade):
+        # traders respond to whatever happened
+        lob = exchange.publish_lob(time, market['symbol'], market['lobframes'], lob_verbose, market['respond_depth'])
+        any_record_frame = False
+        for trader in market['population'].responders(time, lob, trade):
+            # NB respond just updates trader's internal variables
+            # doesn't alter the LOB, so processing each trader in
+            # sequence (rather than random/shuffle) isn't a problem
+            record_frame = trader.respond(time, lob, trade, respond_verbose)
+            if record_frame:
+                any_record_frame = True
+        strats_frame(market, time, any_record_frame)
+
+    def strats_frame(market, time, any_record_frame):
+        # log all the PRSH/PRDE/ZIPSH strategy info for this timestep?
+        if any_record_frame and dump_flags['dump_strats']:
+            # print one more frame to strategy dumpfile
+            dump_strats_frame(time, market['strat_dump'], market['traders'])
+            # record that we've written this frame
+            market['frames_done'].add(int(time))
+
+    def publish_later(market, time, trade):
+        # latency model: the LOB as it is now (and the trade, if any) reaches each trader after that trader's latency
+        lob = exchange.publish_lob(time, market['symbol'], market['lobframes'], lob_verbose, market['respond_depth'])
+        # the delivery's view of the tape mustn't show anything that happens after now
+        lob = dict(lob)
+        tape = exchange[market['symbol']].tape
+        lob['tape'] = Tape_view(tape, tape.seq)
+        # everyone gets the LOB data, but only the traders that subscribe to what's happened will respond to it:
+        # there's one delivery for all the traders with the same latency, listing the ones that respond, and none at
+        # all for zero-latency traders if none of them respond (they always see the LOB as it is, so don't need it)
+        for [trader_latency, responders] in market['population'].responders_by_latency(time, lob, trade):
+            if trader_latency > 0 or len(responders) > 0:
+                market['events'].push(time + trader_latency, ['Publish', trader_latency, lob, trade, responders])
+
+    def remote_orders(market, time):
+        # the quotes and cancels sent through the gateway by this market's REMOTE traders since its last step
+        # returns [whether any of them reached the exchange, the trades their orders made (in the order they were made)]
+        # the traders don't respond to any of it here: market_step does that, once, at the end of the step
+        symbol = market['symbol']
+        traders = market['traders']
+        sent = False
+        trades = []
+        for [conn, tid, msg] in gateway.take(symbol):
+            trader = traders.get(tid)
+            if not isinstance(trader, Trader_Remote):
+                gateway.send(symbol, tid, {'ev': 'reject', 'ref': msg.get('ref'), 'reason': 'not a REMOTE trader'})
+            elif msg['op'] == 'cancel':
+                quote = trader.quotes.get(msg.get('qid'))
+                if quote is None:
+                    gateway.send(symbol, tid, {'ev': 'reject', 'ref': msg.get('ref'), 'reason': 'no such quote'})
+                else:
+                    exchange.del_order(time, symbol, quote, verbose)
+                    trader.quote_gone(quote.qid)
+                    sent = True
+            else:
+                order = trader.remote_order(time, msg, exchange[symbol].quote_id)
+                if order is None:
+                    continue
+                sent = True
+                if latency is not None:
+                    market['events'].push(time + trader.latency, ['Arrive', trader, order])
+                else:
+                    trade = send_order(market, time, trader, order)
+                    if trade is not None:
+                        trades.append(trade)
+        return [sent, trades]
+
+    def remote_publish(market, time):
+        # stream whatever's new on this market's tape and LOB to the gateway's clients
+        symbol = market['symbol']
+        book = exchange[symbol]
+        for record in book.tape.since(market['gateway_seq']):
+            if record['type'] == 'Trade':
+                gateway.publish(symbol, {'ev': 'trade', 'symbol': symbol, 'time': record['time'],
+                                         'price': record['price'], 'qty': record['qty']})
+        market['gateway_seq'] = book.tape.seq
+        if market['gateway_version'] != book.lob_version:
+            market['gateway_version'] = book.lob_version
+            lob = exchange.publish_lob(time, symbol, None, False, gateway.lob_depth)
+            # NB the published levels are a snapshot, so the gateway's thread can send them while the book changes
+            gateway.publish(symbol, {'ev': 'lob', 'symbol': symbol, 'time': time,
+                                     'bids': lob['bids']['lob'], 'asks': lob['asks']['lob']})
+        gateway.flush()
+
+    def order_still_good(trader, order):
+        # an order that reaches the exchange late may no longer fit the customer order that the trader is working
+        if len(trader.orders) == 0 or trader.orders[0].otype != order.otype:
+            return False
+        if order.otype == 'Bid':
+            return order.price <= trader.orders[0].price
+        else:
+            return order.price >= trader.orders[0].price
+
+    def deliver_events(market, time):
+        # latency model: handle every event in this market that's due by now, in time order
+        events = market['events']
+        while len(events) > 0 and events.next_time() <= time:
+            [event_time, event] = events.pop()
+            if event[0] == 'Arrive':
+                # an order reaches the exchange, which processes it and publishes the result
+                [trader, order] = event[1:]
+                if order_still_good(trader, order):
+                    trade = send_order(market, event_time, trader, order)
+                    publish_later(market, event_time, trade)
+                else:
+                    if isinstance(trader, Trader_Remote):
+                        trader.quote_rejected(order, 'arrived too late')
+                    if verbose:
+                        print('%s order from %s arrived too late: %s' % (market['sess_id'], trader.tid, order))
+            else:
+                # published LOB data (and the trade, if there was one) reaches the traders with this latency
+                [trader_latency, lob, trade, responders] = event[1:]
+                market['lobs_seen'][trader_latency] = lob
+                for trader in responders:
+                    record_frame = trader.respond(event_time, lob, trade, respond_verbose)
+                    strats_frame(market, event_time, record_frame)
+
+    # the event schedulers: rather than stepping every timestep, a market jumps straight to its next event, i.e.
+    # a customer order being issued, an auction, a latency-model event, a trader waking, or the end of the session
+    # in the fixed-timestep loop, one trader chosen at random is asked for an order every timestep: in a second, each
+    # trader is asked once on average, and asking a trader that isn't awake (see Trader.awake) does nothing at all;
+    # so a scheduler only needs to wake traders that are awake, and with k of them awake out of n, one of them wakes
+    # (chosen at random) after a wait drawn from the right memoryless distribution: 'events' draws it in continuous
+    # time from an exponential distribution with rate k per second, and 'events-timestep' draws a whole number of
+    # timesteps from a geometric distribution with p=k/n, which reproduces the fixed-timestep loop's statistics
+    # exactly, as every event happens at the timestep it would have happened at in that loop
+    # market['wake'] is [time of the next wake, the number of traders awake when it was drawn]:
+    # if that number has changed by the time it comes round, it's drawn again
+
+    def grid_time(market, step):
+        return starttime + step * market['timestep']
+
+    def grid_step(market, t, later):
+        # the first timestep whose time is later than t (later=True) or no earlier than t (later=False)
+        step = max(0, int((t - starttime) / market['timestep']))
+        while step > 0 and (grid_time(market, step - 1) > t or (not later and grid_time(market, step - 1) == t)):
+            step -= 1
+        while grid_time(market, step) < t or (later and grid_time(market, step) == t):
+            step += 1
+        return step
+
+    def woken_trader(market):
+        # which trader wakes now (or None) to be asked for an order
+        population = market['population']
+        population.sync()
+        n_awake = population.n_awake()
+        [wake_time, wake_n_awake] = market['wake']
+        if n_awake == wake_n_awake:
+            woken = market['time'] == wake_time
+        elif scheduler == 'events-timestep':
+            # the number awake has changed at this timestep: does one of them get asked at it?
+            woken = random.random() < n_awake / len(population)
+        else:
+            woken = False
+        if not woken or n_awake == 0:
+            return None
+        trader = population.pick_awake()
+        # asking it for an order may change whether it's awake
+        population.touch(trader)
+        return trader
+
+    def next_event(market, time):
+        # move the market's clock on to its next event
+        population = market['population']
+        population.sync()
+        n_awake = population.n_awake()
+        pending = market['pending_cust_orders']
+        if scheduler == 'events':
+            wake_time = None
+            next_time = endtime
+            if n_awake > 0:
+                wake_time = time + random.expovariate(n_awake)
+                next_time = min(next_time, wake_time)
+            if len(pending) > 0:
+                # NB customer_orders() only issues an order once time is later than its issue time
+                next_time = min(next_time, math.nextafter(pending.next_time(), math.inf))
+            if auction_interval is not None:
+                next_time = min(next_time, market['next_auction'])
+            if latency is not None and len(market['events']) > 0:
+                next_time = min(next_time, market['events'].next_time())
+            if gateway is not None:
+                # keep an eye on the gateway
+                next_time = min(next_time, time + market['timestep'])
+            market['time'] = max(next_time, math.nextafter(time, math.inf))
+        else:
+            step = market['step']
+            wake_time = None
+            next_step = grid_step(market, endtime, False)
+            if n_awake > 0:
+                p = n_awake / len(population)
+                gap = 1
+                if p < 1:
+                    gap = max(1, math.ceil(math.log(1.0 - random.random()) / math.log(1.0 - p)))
+                wake_time = grid_time(market, step + gap)
+                next_step = min(next_step, step + gap)
+            if len(pending) > 0:
+                next_step = min(next_step, grid_step(market, pending.next_time(), True))
+            else:
+                # the next lot of customer orders gets generated at the next timestep
+                next_step = step + 1
+            if auction_interval is not None:
+                next_step = min(next_step, grid_step(market, market['next_auction'], False))
+            if latency is not None and len(market['events']) > 0:
+                next_step = min(next_step, grid_step(market, market['events'].next_time(), False))
+            if gateway is not None:
+                next_step = step + 1
+            market['step'] = max(next_step, step + 1)
+            market['time'] = grid_time(market, market['step'])
+        market['wake'] = [wake_time, n_awake]
+
+    def market_step(market):
+        # one timestep in one market (or, with an event scheduler, whatever happens at the market's next event)
+        symbol = market['symbol']
+        population = market['population']
+        time = market['time']
 
         # how much time left, as a percentage?
         time_left = (endtime - time) / duration
@@ -2300,80 +4459,281 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
 
         trade = None
 
-        [pending_cust_orders, kills] = customer_orders(time, last_update, traders, trader_stats,
-                                                       order_schedule, pending_cust_orders, orders_verbose)
+        if latency is not None:
+            deliver_events(market, time)
+
+        [market['pending_cust_orders'], kills] = customer_orders(time, last_update, population, market['trader_stats'],
+                                                                 order_schedules[symbol],
+                                                                 market['pending_cust_orders'], orders_verbose)
+        if scheduler == 'events' and len(market['pending_cust_orders']) == 0:
+            # the next lot of customer orders is generated straight away, not at the next timestep
+            market['pending_cust_orders'] = customer_orders(time, last_update, population, market['trader_stats'],
+                                                            order_schedules[symbol], Event_queue(),
+                                                            orders_verbose)[0]
 
         # if any newly-issued customer orders mean quotes on the LOB need to be cancelled, kill them
         if len(kills) > 0:
             # if verbose : print('Kills: %s' % (kills))
             for kill in kills:
-                # if verbose : print('lastquote=%s' % traders[kill].lastquote)
-                if traders[kill].lastquote is not None:
-                    # if verbose : print('Killing order %s' % (str(traders[kill].lastquote)))
-                    exchange.del_order(time, traders[kill].lastquote, verbose)
+                # if verbose : print('quotes=%s' % kill.quotes)
+                for quote in list(kill.quotes.values()):
+                    # if verbose : print('Killing order %s' % (str(quote)))
+                    exchange.del_order(time, symbol, quote, verbose)
+                    kill.quote_gone(quote.qid)
+
+        # anything from the REMOTE traders?
+        remote = False
+        remote_trades = []
+        if gateway is not None:
+            gateway.keep_pace(time)
+            [remote, remote_trades] = remote_orders(market, time)
 
         # get a limit-order quote (or None) from a randomly chosen trader
-        tid = list(traders.keys())[random.randint(0, len(traders) - 1)]
-        order = traders[tid].getorder(time, time_left, exchange.publish_lob(time, lobframes, lob_verbose))
+        # (with the latency model, a trader with nonzero latency sees the LOB as last published to it,
+        # which may be out of date)
+        if scheduler == 'timestep':
+            trader = population.pick()
+        else:
+            trader = woken_trader(market)
+        order = None
+        if trader is not None:
+            lob = None
+            if latency is not None and trader.latency > 0:
+                lob = market['lobs_seen'].get(trader.latency)
+            if lob is None:
+                lob = exchange.publish_lob(time, symbol, market['lobframes'], lob_verbose, trader.lob_depth)
+            order = trader.getorder(time, time_left, lob)
+        elif market['lobframes'] is not None:
+            # nobody woke, but any change to the LOB (e.g. from kills) still goes in the LOB frames file now
+            exchange.publish_lob(time, symbol, market['lobframes'], lob_verbose, 0)
 
         # if verbose: print('Trader Quote: %s' % (order))
 
         if order is not None:
-            if order.otype == 'Ask' and order.price < traders[tid].orders[0].price:
+            if order.otype == 'Ask' and order.price < trader.orders[0].price:
                 sys.exit('Bad ask')
-            if order.otype == 'Bid' and order.price > traders[tid].orders[0].price:
+            if order.otype == 'Bid' and order.price > trader.orders[0].price:
                 sys.exit('Bad bid')
             # send order to exchange
-            traders[tid].n_quotes = 1
-            trade = exchange.process_order2(time, order, process_verbose)
+            if latency is not None:
+                # ... where it arrives after the trader's latency
+                market['events'].push(time + trader.latency, ['Arrive', trader, order])
+            else:
+                trade = send_order(market, time, trader, order)
+
+        if auction_interval is not None and time >= market['next_auction']:
+            trade = run_auction(market, time)
+            if latency is not None:
+                publish_later(market, time, trade)
+
+        if latency is not None:
+            # anything that's due now (e.g. with zero latency, the order just sent) happens in this timestep
+            deliver_events(market, time)
+        elif order is not None or trade is not None or remote:
+            # the traders respond to what's happened in this timestep: once to each trade, in the order they were made
+            # (as for the robots, everyone responds to every trade), or just once if there weren't any
+            trades = remote_trades
             if trade is not None:
-                # trade occurred,
-                # so the counterparties update order lists and blotters
-                traders[trade['party1']].bookkeep(trade, order, bookkeep_verbose, time)
-                traders[trade['party2']].bookkeep(trade, order, bookkeep_verbose, time)
-                if dump_flags['dump_avgbals']:
-                    trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose))
-
-            # traders respond to whatever happened
-            lob = exchange.publish_lob(time, lobframes, lob_verbose)
-            any_record_frame = False
-            for t in traders:
-                # NB respond just updates trader's internal variables
-                # doesn't alter the LOB, so processing each trader in
-                # sequence (rather than random/shuffle) isn't a problem
-                record_frame = traders[t].respond(time, lob, trade, respond_verbose)
-                if record_frame:
-                    any_record_frame = True
-
-            # log all the PRSH/PRDE/ZIPSH strategy info for this timestep?
-            if any_record_frame and dump_flags['dump_strats']:
-                # print one more frame to strategy dumpfile
-                dump_strats_frame(time, strat_dump, traders)
-                # record that we've written this frame
-                frames_done.add(int(time))
-
-        time = time + timestep
+                trades = trades + [trade]
+            if len(trades) == 0:
+                respond_all(market, time, None)
+            for step_trade in trades:
+                respond_all(market, time, step_trade)
 
-    # session has ended
+        if gateway is not None:
+            remote_publish(market, time)
+
+        if scheduler == 'timestep':
+            market['time'] = time + market['timestep']
+        else:
+            next_event(market, time)
+
+    def fork_file(f, fname):
+        # a forked process's own copy of an output file, starting with everything written to it so far
+        if isinstance(f, LOB_frame_writer):
+            f.fork(fname)
+            return f
+        f.close()
+        shutil.copyfile(f.name, fname)
+        return open(fname, 'a')
+
+    def fork_session(time):
+        # fork a child process for each branch: returns the branch number in the child, or None in the parent
+        if not hasattr(os, 'fork'):
+            sys.exit('FAIL: market_session branches need os.fork()')
+        # anything still buffered would otherwise be written twice, once by the parent and once by the child
+        for market in markets:
+            for f in [market['strat_dump'], market['lobframes'], market['avg_bals']]:
+                if f is not None:
+                    f.flush()
+            book = exchange[market['symbol']]
+            for archive in [book.tape.archive, book.journal, book.lob_index]:
+                if archive is not None:
+                    archive.flush()
+        sys.stdout.flush()
+        # NB the random module reseeds itself in a forked child, so the child has to be given the parent's state
+        random_state = random.getstate()
+        for b in range(1, len(branches) + 1):
+            pid = os.fork()
+            if pid == 0:
+                random.setstate(random_state)
+                for market in markets:
+                    market['sess_id'] = '%s_b%02d' % (market['sess_id'], b)
+                    for key, suffix in [['strat_dump', '_strats.csv'], ['lobframes', '_LOB_frames'],
+                                        ['avg_bals', '_avg_balance.csv']]:
+                        if market[key] is not None:
+                            if key == 'lobframes':
+                                suffix += os.path.splitext(market[key].name)[1]
+                            market[key] = fork_file(market[key], market['sess_id'] + suffix)
+                    book = exchange[market['symbol']]
+                    if book.tape.archive is not None:
+                        book.tape.archive.fork(market['sess_id'] + '_tape_archive.csv')
+                    if book.journal is not None:
+                        book.journal.fork(market['sess_id'] + '_journal.csv')
+                    if book.lob_index is not None:
+                        book.lob_index.fork(market['lobframes'].name)
+                branches[b - 1]({'time': time, 'branch': b, 'exchange': exchange, 'markets': markets})
+                return b
+            children.append(pid)
+        return None
+
+    duration = float(endtime - starttime)
+
+    last_update = -1.0
+
+    markets = []
+    for symbol in symbols:
+        markets.append(new_market(symbol))
 
-    # write trade_stats for this session (NB could use this to write end-of-session summary only)
-    if dump_flags['dump_avgbals']:
-        trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose))
-        avg_bals.close()
+    fork_time = sess_params.get('fork_time')
+    branches = sess_params.get('branches', [])
+    branch = None       # which branch this process is running (None => the parent)
+    children = []       # process i.d.s of the branches
+    if gateway is not None and len(branches) > 0:
+        sys.exit('FAIL: a session with a gateway can\'t fork branches')
 
-    if dump_flags['dump_tape']:
-        # dump the tape (transactions only -- not writing cancellations)
-        exchange.tape_dump(sess_id + '_tape.csv', 'w', 'keep')
+    if verbose:
+        print('\n%s;  ' % sess_id)
 
-    if dump_flags['dump_blotters']:
-        # record the blotter for each trader
-        blotter_dump(sess_id, traders)
+    while True:
+
+        # step whichever market's clock is furthest behind, so the markets all move forward together
+        market = None
+        for m in markets:
+            if m['time'] < endtime and (market is None or m['time'] < market['time']):
+                market = m
+        if market is None:
+            break
+
+        if fork_time is not None and market['time'] >= fork_time:
+            fork_time = None
+            branch = fork_session(market['time'])
+
+        if multi:
+            random.setstate(market['random_state'])
+        market_step(market)
+        if multi:
+            market['random_state'] = random.getstate()
+
+    # session has ended
+
+    if gateway is not None:
+        gateway.end_session(endtime, symbols)
+
+    for market in markets:
+
+        symbol = market['symbol']
+        time = market['time']
+        lobframes = market['lobframes']
+
+        # write trade_stats for this session (NB could use this to write end-of-session summary only)
+        if dump_flags['dump_avgbals']:
+            trade_stats(market['sess_id'], market['traders'], market['avg_bals'], time,
+                        exchange.publish_lob(time, symbol, lobframes, lob_verbose, 0))
+            market['avg_bals'].close()
+
+        if dump_flags['dump_tape']:
+            # dump the tape (transactions only -- not writing cancellations)
+            exchange[symbol].tape_dump(market['sess_id'] + '_tape.csv', 'w', 'keep', index_bucket)
+            archive = exchange[symbol].tape.archive
+            archive.close()
+            if not keep_tape_archive:
+                # it was only needed for the tape dump
+                os.remove(archive.fname)
+
+        if dump_flags['dump_blotters']:
+            # record the blotter for each trader
+            blotter_dump(market['sess_id'], market['traders'])
+
+        if dump_flags.get('dump_journal', False):
+            exchange[symbol].journal.close()
+
+        if dump_flags['dump_strats']:
+            market['strat_dump'].close()
+
+        if dump_flags['dump_lobs']:
+            lobframes.close()
+            if exchange[symbol].lob_index is not None:
+                exchange[symbol].lob_index.close()
+
+    if branch is not None:
+        # this is a branch's own process, and it's finished: it mustn't go back to whatever called market_session
+        sys.stdout.flush()
+        os._exit(0)
+
+    for pid in children:
+        status = os.waitpid(pid, 0)[1]
+        if status != 0:
+            sys.exit('FAIL: branch of market_session %s exited with status %d' % (sess_id, status))
+
+
+# a session with many instruments, shared out between n_workers worker processes
+# trader_specs and order_schedules are dictionaries indexed by symbol, one entry per instrument
+# each worker runs market_session on its share of the instruments, and every output file is tagged with its symbol;
+# each instrument's random-number seed is chosen here, so the results don't depend on how they're shared out
+def sharded_market_session(sess_id, starttime, endtime, trader_specs, order_schedules, dump_flags, verbose,
+                           sess_params=None, n_workers=None):
+
+    if sess_params is None:
+        sess_params = {}
+    if 'gateway' in sess_params:
+        sys.exit('FAIL: sharded_market_session can\'t have a gateway')
+
+    symbols = list(trader_specs.keys())
+    seeds = {}
+    for symbol in symbols:
+        seeds[symbol] = random.randrange(2 ** 32)
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, len(symbols)))
+
+    workers = []
+    for w in range(n_workers):
+        shard = symbols[w::n_workers]
+        shard_params = dict(sess_params)
+        shard_params['symbols'] = shard
+        shard_params['seeds'] = {}
+        shard_specs = {}
+        shard_schedules = {}
+        for symbol in shard:
+            shard_params['seeds'][symbol] = seeds[symbol]
+            shard_specs[symbol] = trader_specs[symbol]
+            shard_schedules[symbol] = order_schedules[symbol]
+        args = (sess_id, starttime, endtime, shard_specs, shard_schedules, dump_flags, verbose, shard_params)
+        if n_workers == 1:
+            # no need for another process
+            market_session(*args)
+        else:
+            worker = multiprocessing.Process(target=market_session, args=args)
+            worker.start()
+            workers.append(worker)
 
-    if dump_flags['dump_strats']:
-        strat_dump.close()
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            sys.exit('FAIL: market_session worker for %s exited with code %s' % (sess_id, worker.exitcode))
 
-    if dump_flags['dump_lobs']:
-        lobframes.close()
 
 #############################
 
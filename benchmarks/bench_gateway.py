@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# bench_gateway.py: throughput of the Exchange_gateway with dozens of external traders connected at once
+#
+# runs a market_session whose population is half robots and half REMOTE traders, and a separate client process that
+# opens one connection per REMOTE trader; each client quotes on every customer order it's assigned, and also sends
+# a stream of re-quotes in batches, so the gateway has plenty of work.
+# prints how many messages went each way, how many quotes and fills the remote traders got, and the rate per second;
+# a batch size of 1 (one message per line) is timed alongside bigger batches for comparison.
+#
+# run from the top-level directory:  python benchmarks/bench_gateway.py
+
+import os
+import sys
+import json
+import random
+import asyncio
+import multiprocessing
+import time as chrono
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import BSE
+
+
+async def client(address, tid, batch, counts):
+    # one external trader: quote each customer order at a random price within its limit, re-quoting in batches
+    reader, writer = await asyncio.open_connection(address[0], address[1])
+    writer.write(json.dumps({'op': 'hello', 'tid': tid}).encode() + b'\n')
+    rng = random.Random(tid)
+    limit = None
+    ref = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        counts['lines'] += 1
+        ended = False
+        for event in json.loads(line):
+            counts['events'] += 1
+            counts[event['ev']] = counts.get(event['ev'], 0) + 1
+            if event['ev'] == 'assign':
+                limit = [event['otype'], event['price']]
+            elif event['ev'] == 'done':
+                limit = None
+            elif event['ev'] == 'end':
+                ended = True
+        if ended:
+            break
+        if limit is not None:
+            msgs = []
+            for b in range(batch):
+                ref += 1
+                if limit[0] == 'Bid':
+                    price = rng.randint(max(BSE.bse_sys_minprice, limit[1] - 30), limit[1])
+                else:
+                    price = rng.randint(limit[1], min(BSE.bse_sys_maxprice, limit[1] + 30))
+                msgs.append({'op': 'order', 'otype': limit[0], 'price': price, 'qty': 1, 'ref': ref})
+            counts['sent'] += len(msgs)
+            if batch == 1:
+                for msg in msgs:
+                    writer.write(json.dumps(msg).encode() + b'\n')
+            else:
+                writer.write(json.dumps(msgs).encode() + b'\n')
+            await writer.drain()
+    writer.close()
+
+
+def run_clients(address, tids, batch, results):
+    counts = {'lines': 0, 'events': 0, 'sent': 0}
+
+    async def all_clients():
+        await asyncio.gather(*[client(address, tid, batch, counts) for tid in tids])
+
+    asyncio.run(all_clients())
+    results.put(counts)
+
+
+def bench(n_remote, batch, duration, pace):
+    gateway = BSE.Exchange_gateway(('127.0.0.1', 0), pace=pace)
+    gateway.start()
+
+    n_side = n_remote // 2
+    trader_spec = {'buyers': [('ZIC', n_side), ('REMOTE', n_side)], 'sellers': [('ZIC', n_side), ('REMOTE', n_side)]}
+    tids = ['B%02d' % t for t in range(2 * n_side)] + ['S%02d' % t for t in range(2 * n_side)]
+    schedule = {'sup': [{'from': 0, 'to': duration, 'ranges': [(50, 150)], 'stepmode': 'fixed'}],
+                'dem': [{'from': 0, 'to': duration, 'ranges': [(50, 150)], 'stepmode': 'fixed'}],
+                'interval': 10, 'timemode': 'drip-poisson'}
+    dump_flags = {'dump_blotters': False, 'dump_lobs': False, 'dump_strats': False,
+                  'dump_avgbals': False, 'dump_tape': False}
+
+    # which of the tids will be REMOTE depends on the population shuffle, so clients say hello as all of them:
+    # those that turn out to be robots just get rejects
+    results = multiprocessing.Queue()
+    clients = multiprocessing.Process(target=run_clients, args=(gateway.address, tids, batch, results))
+    clients.start()
+    if not gateway.wait_clients(len(tids), timeout=30):
+        sys.exit('FAIL: clients didn\'t connect')
+
+    random.seed(1)
+    t0 = chrono.perf_counter()
+    BSE.market_session('bench_gateway', 0, duration, trader_spec, schedule, dump_flags, False,
+                       {'gateway': gateway})
+    t1 = chrono.perf_counter()
+    counts = results.get()
+    clients.join()
+    gateway.close()
+    return [t1 - t0, counts]
+
+
+if __name__ == "__main__":
+
+    duration = 600
+    pace = 300
+
+    print('%8s %6s %9s %9s %9s %8s %8s %8s %9s' %
+          ('clients', 'batch', 'wall_s', 'sent', 'msg/s', 'acks', 'rejects', 'fills', 'lines'))
+    for n_remote in [20, 60]:
+        for batch in [1, 10]:
+            [wall, counts] = bench(n_remote, batch, duration, pace)
+            print('%8d %6d %9.2f %9d %9.0f %8d %8d %8d %9d' %
+                  (2 * n_remote, batch, wall, counts['sent'], counts['sent'] / wall, counts.get('ack', 0),
+                   counts.get('reject', 0), counts.get('fill', 0), counts['lines']))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# bench_orderbook.py: per-order cost of the BSE orderbook as the book gets deeper
+#
+# fills one side of the book with n_resting orders (one per trader-id, spread over the whole price range)
+# then times a stream of overwrites and cancels against it (each cancel is of the trader's order that's on the book).
+# with incremental price-level maintenance the cost per order should stay roughly flat as the book deepens;
+# the original full-rebuild book (reference/BSE.py) is timed alongside it for comparison,
+# as is the dense tick-ladder book (Orderbook_ladder).
+#
+# run from the top-level directory:  python benchmarks/bench_orderbook.py
+
+import os
+import sys
+import random
+import importlib.util
+import time as chrono
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import BSE
+
+
+def load_reference():
+    # the reference copy of BSE.py still rebuilds the whole book side on every add/delete
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reference', 'BSE.py')
+    spec = importlib.util.spec_from_file_location('BSE_reference', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_orders(bse, book_class, n_resting, n_ops, seed):
+    # returns mean microseconds per order operation on a book side holding n_resting orders
+    rng = random.Random(seed)
+    half = book_class('Bid', bse.bse_sys_minprice)
+    tids = ['B%05d' % t for t in range(n_resting)]
+    resting = {}    # the order each trader has on the book, so a cancel names one that's really there
+    qid = 0
+    for tid in tids:
+        order = bse.Order(tid, 'Bid', rng.randint(bse.bse_sys_minprice, bse.bse_sys_maxprice), 1, 0.0, qid)
+        half.book_add(order)
+        resting[tid] = order
+        qid += 1
+
+    # each op is [order to cancel (or None), order to add]
+    ops = []
+    for op in range(n_ops):
+        tid = tids[rng.randint(0, n_resting - 1)]
+        price = rng.randint(bse.bse_sys_minprice, bse.bse_sys_maxprice)
+        order = bse.Order(tid, 'Bid', price, 1, float(op), qid + op)
+        if op % 2 == 0:
+            ops.append([None, order])           # overwrite the trader's resting order with one at a new price
+        else:
+            ops.append([resting[tid], order])   # cancel the trader's resting order, then quote again
+        resting[tid] = order
+
+    t0 = chrono.perf_counter()
+    for [cancel, order] in ops:
+        if cancel is not None:
+            half.book_del(cancel)
+        half.book_add(order)
+    t1 = chrono.perf_counter()
+    return 1e6 * (t1 - t0) / n_ops
+
+
+if __name__ == "__main__":
+
+    reference = load_reference()
+    depths = [10, 100, 1000, 10000]
+    n_ops = 2000
+
+    print('%10s %18s %18s %18s' % ('n_resting', 'incremental us/op', 'ladder us/op', 'rebuild us/op'))
+    for depth in depths:
+        incr = time_orders(BSE, BSE.Orderbook_half, depth, n_ops, depth)
+        ladder = time_orders(BSE, BSE.Orderbook_ladder, depth, n_ops, depth)
+        if depth <= 1000:
+            rebuild = time_orders(reference, reference.Orderbook_half, depth, n_ops, depth)
+        else:
+            # the full rebuild gets very slow here; a smaller sample is enough to make the point
+            rebuild = time_orders(reference, reference.Orderbook_half, depth, n_ops // 20, depth)
+        print('%10d %18.2f %18.2f %18.2f' % (depth, incr, ladder, rebuild))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# bench_records.py: memory and allocation cost of Order objects and tape records
+#
+# compares the compact representation (Order with __slots__, Trade_record/Cancel_record)
+# against the "legacy" representation it replaced (Order with a per-instance __dict__, tape records as dicts):
+#   (1) bytes per object, measured with tracemalloc
+#   (2) a whole market session in each representation, run in a fresh process, reporting wall-clock time,
+#       allocation rate (number of orders/records created, times bytes per object, per simulated hour),
+#       and peak resident set size
+#
+# run from the top-level directory:  python benchmarks/bench_records.py [n_days]
+# n_days defaults to 10, which takes a while; use e.g. 1 for a quicker look
+
+import os
+import sys
+import gc
+import collections
+import resource
+import subprocess
+import tracemalloc
+import time as chrono
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import BSE
+
+
+# the representations used before Order got __slots__ and the tape records became classes
+class Legacy_order:
+
+    def __init__(self, tid, otype, price, qty, time, qid):
+        self.tid = tid
+        self.otype = otype
+        self.price = price
+        self.qty = qty
+        self.time = time
+        self.qid = qid
+
+    def __str__(self):
+        return '[%s %s P=%03d Q=%s T=%5.2f QID:%d]' % \
+               (self.tid, self.otype, self.price, self.qty, self.time, self.qid)
+
+
+def legacy_trade_record(time, price, party1, party2, qty, qid1, qid2):
+    return {'type': 'Trade', 'time': time, 'price': price, 'party1': party1, 'party2': party2, 'qty': qty,
+            'qid1': qid1, 'qid2': qid2}
+
+
+def legacy_cancel_record(time, order):
+    return {'type': 'Cancel', 'time': time, 'order': order}
+
+
+def use_legacy_representation():
+    BSE.Order = Legacy_order
+    BSE.Trade_record = legacy_trade_record
+    BSE.Cancel_record = legacy_cancel_record
+
+
+def count_creations(counts):
+    # wrap the constructors used by BSE so that counts[name] goes up by one every time one is called
+
+    def counted(make, name):
+        def counted_make(*args):
+            counts[name] += 1
+            return make(*args)
+        return counted_make
+
+    sizes = {'Order': bytes_per_object(lambda t, i, j: BSE.Order('B00', 'Bid', 100, 1, t, i), 10000),
+             'Trade': bytes_per_object(lambda t, i, j: BSE.Trade_record(t, 100, 'S00', 'B00', 1, i, j), 10000),
+             'Cancel': bytes_per_object(lambda t, i, j: BSE.Cancel_record(t, None), 10000)}
+    BSE.Order = counted(BSE.Order, 'Order')
+    BSE.Trade_record = counted(BSE.Trade_record, 'Trade')
+    BSE.Cancel_record = counted(BSE.Cancel_record, 'Cancel')
+    return sizes
+
+
+def bytes_per_object(make, n):
+    # mean number of bytes allocated per object when n of them are alive at once
+    # the values it holds are made first and not counted: in a session they already exist (the time, the orders' qids)
+    values = [[1.0 * i, i, i + 1] for i in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(*v) for v in values]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    list_bytes = sys.getsizeof(objects)
+    del objects
+    return (after - before - list_bytes) / n
+
+
+def run_session(n_days):
+    # one market session with no output files; returns (wall-clock secs, MB allocated per sim hour, peak RSS in MB)
+    counts = collections.Counter()
+    sizes = count_creations(counts)
+    end_time = 60.0 * 60.0 * 24 * n_days
+    range1 = (50, 150)
+    supply_schedule = [{'from': 0.0, 'to': end_time, 'ranges': [range1], 'stepmode': 'fixed'}]
+    demand_schedule = [{'from': 0.0, 'to': end_time, 'ranges': [range1], 'stepmode': 'fixed'}]
+    order_sched = {'sup': supply_schedule, 'dem': demand_schedule, 'interval': 15, 'timemode': 'drip-poisson'}
+    buyers_spec = [('SHVR', 5), ('GVWY', 5), ('ZIC', 5), ('ZIP', 5)]
+    traders_spec = {'sellers': buyers_spec, 'buyers': buyers_spec}
+    dump_flags = {'dump_blotters': False, 'dump_lobs': False, 'dump_strats': False,
+                  'dump_avgbals': False, 'dump_tape': False}
+    BSE.random.seed(1)
+    t0 = chrono.perf_counter()
+    BSE.market_session('bench_records', 0.0, end_time, traders_spec, order_sched, dump_flags, False)
+    t1 = chrono.perf_counter()
+    allocated = 0
+    for name in counts:
+        allocated += counts[name] * sizes[name]
+    mb_per_hour = allocated / (1024.0 * 1024.0) / (end_time / 3600.0)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return t1 - t0, mb_per_hour, peak_rss_mb
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'session':
+        # child process: run one session in the given representation and print the results
+        if sys.argv[2] == 'legacy':
+            use_legacy_representation()
+        secs, mb_per_hour, rss = run_session(float(sys.argv[3]))
+        print('%f %f %f' % (secs, mb_per_hour, rss))
+        sys.exit(0)
+
+    n_days = 10
+    if len(sys.argv) > 1:
+        n_days = float(sys.argv[1])
+
+    n = 100000
+    print('bytes per object (%d alive):' % n)
+    print('  %-22s %8.1f' % ('Order (__slots__)',
+                             bytes_per_object(lambda t, i, j: BSE.Order('B00', 'Bid', 100, 1, t, i), n)))
+    print('  %-22s %8.1f' % ('Order (legacy)',
+                             bytes_per_object(lambda t, i, j: Legacy_order('B00', 'Bid', 100, 1, t, i), n)))
+    print('  %-22s %8.1f' % ('Trade_record',
+                             bytes_per_object(lambda t, i, j: BSE.Trade_record(t, 100, 'S00', 'B00', 1, i, j), n)))
+    print('  %-22s %8.1f' % ('trade dict (legacy)',
+                             bytes_per_object(lambda t, i, j: legacy_trade_record(t, 100, 'S00', 'B00', 1, i, j), n)))
+    print('  %-22s %8.1f' % ('Cancel_record', bytes_per_object(lambda t, i, j: BSE.Cancel_record(t, None), n)))
+    print('  %-22s %8.1f' % ('cancel dict (legacy)',
+                             bytes_per_object(lambda t, i, j: legacy_cancel_record(t, None), n)))
+
+    print('\n%g-day session, 40 traders:' % n_days)
+    print('  %-10s %10s %16s %14s' % ('records', 'secs', 'MB alloc/sim-hr', 'peak RSS MB'))
+    for representation in ['compact', 'legacy']:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'session', representation, str(n_days)],
+                             capture_output=True, text=True, check=True).stdout.split()
+        print('  %-10s %10.1f %16.2f %14.1f' % (representation, float(out[0]), float(out[1]), float(out[2])))